@@ -0,0 +1,7 @@
+# Loaded by gunicorn from the working directory
+
+
+def post_fork(server, worker):
+    from rsvp.app import start_background_workers
+
+    start_background_workers()
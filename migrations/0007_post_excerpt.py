@@ -0,0 +1,13 @@
+from rsvp.utils import html_excerpt, markdown_to_html
+
+
+def up(db):
+    for post in db.post.find({'excerpt': {'$exists': False}}):
+        html = post.get('html_content') or markdown_to_html(post.get('content'))
+        db.post.find_one_and_update(
+            {'_id': post['_id']}, {'$set': {'excerpt': html_excerpt(html)}}
+        )
+
+
+def down(db):
+    db.post.update_many({}, {'$unset': {'excerpt': ''}})
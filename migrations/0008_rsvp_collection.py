@@ -0,0 +1,59 @@
+from pymongo import ASCENDING, ReplaceOne
+
+
+# RSVPs of users other than the anonymous user, who can RSVP many times
+ANONYMOUS_EMAIL = 'anonymous@example.com'
+NAMED_USERS = {
+    '$or': [{'user': {'$lt': ANONYMOUS_EMAIL}}, {'user': {'$gt': ANONYMOUS_EMAIL}}]
+}
+
+
+def up(db):
+    db.rsvp.create_index(
+        [('event', ASCENDING), ('user', ASCENDING)],
+        unique=True,
+        partialFilterExpression=NAMED_USERS,
+    )
+    db.rsvp.create_index(
+        [
+            ('event', ASCENDING),
+            ('cancelled', ASCENDING),
+            ('waitlisted', ASCENDING),
+            ('date', ASCENDING),
+        ]
+    )
+    for event in db.event.find({'rsvps': {'$exists': True}}, {'rsvps': 1}):
+        # Users RSVPed more than once are left with their first RSVP
+        rsvps, users = [], set()
+        for rsvp in event['rsvps']:
+            user = rsvp.get('user')
+            if user != ANONYMOUS_EMAIL and user in users:
+                print('Dropping duplicate RSVP {} of {}'.format(rsvp['_id'], user))
+                continue
+            users.add(user)
+            rsvps.append(rsvp)
+        # Upserts, so that an interrupted migration can be run again
+        requests = [
+            ReplaceOne(
+                {'_id': rsvp['_id']}, dict(rsvp, event=event['_id']), upsert=True
+            )
+            for rsvp in rsvps
+        ]
+        if requests:
+            db.rsvp.bulk_write(requests, ordered=False)
+        db.event.update_one(
+            {'_id': event['_id']},
+            {'$unset': {'rsvps': ''}, '$inc': {'version': 1}},
+        )
+
+
+def down(db):
+    rsvps = {}
+    for rsvp in db.rsvp.find().sort('date', ASCENDING):
+        rsvps.setdefault(rsvp.pop('event'), []).append(rsvp)
+    for event in db.event.find({}, {'_id': 1}):
+        db.event.update_one(
+            {'_id': event['_id']},
+            {'$set': {'rsvps': rsvps.get(event['_id'], [])}, '$inc': {'version': 1}},
+        )
+    db.rsvp.drop()
@@ -2,7 +2,7 @@ import datetime
 import json
 
 from bson.objectid import ObjectId
-from flask import request, jsonify, flash
+from flask import request, jsonify, flash, url_for
 from flask_login import current_user, login_required
 from mongoengine.errors import DoesNotExist
 
@@ -20,11 +20,15 @@ def api_events():
         events = events.filter(date__gte=start)
     if end:
         events = events.filter(date__lte=end)
-    return jsonify(json.loads(events.to_json()))
+    events = json.loads(events.to_json())
+    # The RSVPs aren't part of the events, only their counts are sent
+    counts = RSVP.active_counts([ObjectId(event["_id"]["$oid"]) for event in events])
+    for event in events:
+        event["rsvp_count"] = counts.get(ObjectId(event["_id"]["$oid"]), 0)
+    return jsonify(events)
 
 
-def event_to_attendance(event, user):
-    attended = event.rsvps.filter(user=user, cancelled=False, waitlisted=False).count()
+def event_to_attendance(event, attended):
     return {
         "year": event.date.year,
         "month": event.date.strftime("%m-%b"),
@@ -37,7 +41,9 @@ def event_to_attendance(event, user):
 @login_required
 def api_attendance():
     events = Event.objects.filter(cancelled=False)
-    data = [event_to_attendance(event, current_user) for event in events]
+    rsvps = RSVP.objects(user=current_user.email, cancelled=False, waitlisted=False)
+    attended = {event.pk for event in rsvps.scalar("event")}
+    data = [event_to_attendance(event, int(event.id in attended)) for event in events]
     return jsonify(data)
 
 
@@ -65,8 +71,12 @@ def api_rsvps(event_id):
     event = Event.objects.get(id=event_id)
     if request.method == "GET":
         event_json = json.loads(event.to_json(use_db_field=False))
-        for i, rsvp in enumerate(event.rsvps):
-            event_json["rsvps"][i]["user"] = json.loads(rsvp.user.fetch().to_json())
+        rsvps = event.rsvp_partition
+        event_json["rsvps"] = []
+        for rsvp in rsvps.all:
+            rsvp_json = json.loads(rsvp.to_json(use_db_field=False))
+            rsvp_json["user"] = json.loads(rsvps.user(rsvp).to_json())
+            event_json["rsvps"].append(rsvp_json)
         return json.dumps(event_json)
 
     if not event.can_rsvp(current_user):
@@ -89,38 +99,36 @@ def api_rsvps(event_id):
         else:
             return '{"error": "user does not exist"}', 400
 
-    new_rsvp = (user.email == ANONYMOUS_EMAIL) or Event.objects.filter(
-        id=event.id, rsvps__user=user
-    ).count() == 0
-
-    if new_rsvp:
-        data = {
-            "rsvp_by": (
-                current_user.email if current_user.is_authenticated else ANONYMOUS_EMAIL
-            ),
-            "user": user.email,
-        }
-        data.update(doc)
-        if user.email == ANONYMOUS_EMAIL:
-            data["note"] = (
-                "{user} ({note})".format(**data) if data["note"] else data["user"]
-            )
-            data["user"] = user.email
-        rsvp = RSVP(**data)
-        if not (rsvp.user.fetch().email == ANONYMOUS_EMAIL and rsvp.cancelled):
-            event.update(push__rsvps=rsvp)
-    else:
-        rsvp = event.rsvps.get(user=user)
+    data = {
+        "rsvp_by": (
+            current_user.email if current_user.is_authenticated else ANONYMOUS_EMAIL
+        ),
+        "user": user.email,
+    }
+    data.update(doc)
+    if user.email == ANONYMOUS_EMAIL:
+        data["note"] = (
+            "{user} ({note})".format(**data) if data["note"] else data["user"]
+        )
+        data["user"] = user.email
+    rsvp = RSVP(**data)
+
+    if user.email == ANONYMOUS_EMAIL and rsvp.cancelled:
+        return rsvp.to_json()
+    existing = event.add_rsvp(rsvp)
+    if existing is not None:
+        rsvp = existing
+        updates = {"cancelled": doc.get("cancelled", False)}
         if "note" in doc:
-            rsvp.note = doc["note"]
+            updates["note"] = doc["note"]
         # Update the timestamp if a cancelled RSVP is being updated, adding
         # notes to an existing RSVP should not change the timestamp.
         if rsvp.cancelled:
-            rsvp.date = datetime.datetime.now()
-        rsvp.cancelled = doc.get("cancelled", False)
+            updates["date"] = datetime.datetime.now()
+        event.update_rsvp(rsvp, **updates)
 
-    event.save()
     event.update_waitlist()
+    rsvp.reload()
     return rsvp.to_json()
 
 
@@ -140,10 +148,9 @@ def api_rsvp(event_id, rsvp_id):
         return json.dumps({"error": "cannot modify event"}), 404
 
     if rsvp.user.fetch().email == ANONYMOUS_EMAIL:
-        event.update(pull__rsvps=rsvp)
+        event.delete_rsvp(rsvp)
     else:
-        rsvp.cancelled = True
-    event.save()
+        event.update_rsvp(rsvp, cancelled=True)
     event.update_waitlist()
     return json.dumps({"deleted": "true"})
 
@@ -156,10 +163,32 @@ def api_users():
 
 @app.route("/api/posts/", methods=["GET"])
 def api_posts():
+    """List posts, newest first, a page at a time.
+
+    Only summaries are returned, unless ``full`` is set. The URL of the next
+    page, if any, is sent in the ``Link`` header.
+
+    """
     all_posts = bool(request.values.get("all", False))
+    full = bool(request.values.get("full", False))
     if current_user.is_authenticated and all_posts:
         posts = Post.published_posts()
     else:
         posts = Post.public_posts()
-    data = json.loads(posts.to_json())
-    return jsonify(data)
+    limit = request.values.get("limit", app.config["POSTS_PER_PAGE"], type=int)
+    limit = max(1, min(limit, 100))
+    try:
+        posts, next_cursor = Post.page(
+            posts, before=request.values.get("before"), limit=limit, full=full
+        )
+    except ValueError:
+        return '{"error": "invalid cursor"}', 400
+
+    response = jsonify(posts)
+    if next_cursor:
+        args = request.values.to_dict()
+        args["before"] = next_cursor
+        response.headers["Link"] = '<{}>; rel="next"'.format(
+            url_for("api_posts", **args)
+        )
+    return response
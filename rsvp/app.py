@@ -1,5 +1,6 @@
 import datetime
 import os
+import threading
 
 from flask import Flask, redirect, session, url_for
 from flask_dance.consumer import oauth_authorized
@@ -8,10 +9,15 @@ from flask_login import LoginManager, current_user, login_user
 from flaskext.versioned import Versioned
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from .cache import fragment_cache, page_cache
+from .mailer import mail_worker
+from .notifications import notification_dispatcher
+from .middleware import LegacyHostRedirect
 from .models import ANONYMOUS_EMAIL, AnonymousUser, GDrivePhoto, Post, User, db
 from .utils import (
     format_date,
     format_gphoto_time,
+    precompute_passwords,
     rsvp_by,
     rsvp_name,
     send_approval_email,
@@ -19,9 +25,36 @@ from .utils import (
 
 app = Flask(__name__)
 app.config.from_envvar("SETTINGS")
-app.wsgi_app = ProxyFix(app.wsgi_app)
+app.wsgi_app = ProxyFix(
+    LegacyHostRedirect(
+        app.wsgi_app, app.config["CANONICAL_HOST"], app.config["LEGACY_HOSTS"]
+    )
+)
 versioned = Versioned(app)
 db.init_app(app)
+fragment_cache.init_app(app)
+page_cache.init_app(app)
+mail_worker.init_app(app)
+notification_dispatcher.init_app(app)
+
+
+def start_background_workers():
+    """Start the threads that only the web server processes need.
+
+    Called from the gunicorn ``post_fork`` hook, so that the scripts and cron
+    jobs that import the app don't start them.
+
+    """
+    # Derive the social account passwords shown on /media, off the request path
+    if app.config["PRECOMPUTE_SOCIAL_PASSWORDS"]:
+        threading.Thread(
+            target=precompute_passwords,
+            args=(app.config["SOCIAL"], app.secret_key),
+            daemon=True,
+        ).start()
+    mail_worker.start()
+    notification_dispatcher.start()
+
 
 # Create anonymous user
 try:
@@ -0,0 +1,154 @@
+from cachelib import FileSystemCache, NullCache, SimpleCache
+from flask import current_app, g, has_app_context, request
+from markupsafe import Markup
+
+
+def make_cache(config, prefix):
+    """Create a cachelib cache from the ``<prefix>_CACHE_*`` settings.
+
+    The type can be "simple" (per-process memory), "filesystem" (shared by all
+    the workers on a machine) or "null" (no caching).
+
+    """
+    type_ = config.get("{}_CACHE_TYPE".format(prefix), "simple")
+    timeout = config.get("{}_CACHE_TIMEOUT".format(prefix), 300)
+    threshold = config.get("{}_CACHE_THRESHOLD".format(prefix), 500)
+    if type_ == "simple":
+        return SimpleCache(threshold=threshold, default_timeout=timeout)
+    elif type_ == "filesystem":
+        return FileSystemCache(
+            config["{}_CACHE_DIR".format(prefix)],
+            threshold=threshold,
+            default_timeout=timeout,
+        )
+    elif type_ == "null":
+        return NullCache()
+    else:
+        raise ValueError("Unknown cache type: {}".format(type_))
+
+
+# Name of the counter bumped when user names change, which html showing the
+# names is keyed by, so that all the processes miss the html with old names
+PROFILES_GENERATION = "user-profiles"
+
+
+def profile_generation():
+    """Return the generation of the user profiles, read once per request."""
+    from .models import CacheGeneration
+
+    if not has_app_context():
+        return CacheGeneration.get_value(PROFILES_GENERATION)
+    if "profile_generation" not in g:
+        g.profile_generation = CacheGeneration.get_value(PROFILES_GENERATION)
+    return g.profile_generation
+
+
+def invalidate_profiles():
+    from .models import CacheGeneration
+
+    CacheGeneration.bump(PROFILES_GENERATION)
+    if has_app_context():
+        g.pop("profile_generation", None)
+
+
+class FragmentCache:
+    """Cache for rendered html fragments of documents.
+
+    Fragments are rendered from ``templates/fragments/<name>.html``, with the
+    document available as ``doc``, and are keyed by the document's id and
+    version, and the generation of the user profiles. Fragments must not
+    depend on the logged in user.
+
+    """
+
+    def __init__(self, app=None):
+        self.cache = NullCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache = make_cache(app.config, "FRAGMENT")
+        app.jinja_env.globals["fragment"] = self.render
+
+    @staticmethod
+    def key(name, doc, generation):
+        return "{}:{}:{}:{}:{}".format(
+            doc._get_collection_name(), doc.pk, doc.version, generation, name
+        )
+
+    def render(self, name, doc, fields=()):
+        """Render a fragment for the document, or return it from the cache.
+
+        ``fields`` which the fragment needs, but that may not have been loaded
+        by the query, are reloaded only if the fragment isn't in the cache.
+
+        """
+        key = self.key(name, doc, profile_generation())
+        html = self.cache.get(key)
+        if html is None:
+            if fields:
+                doc.reload(*fields)
+            template = current_app.jinja_env.get_template(
+                "fragments/{}.html".format(name)
+            )
+            html = template.render(doc=doc)
+            self.cache.set(key, html)
+        return Markup(html)
+
+    def invalidate(self, doc, names):
+        if doc.pk is None:
+            return
+        generation = profile_generation()
+        self.cache.delete_many(*(self.key(name, doc, generation) for name in names))
+
+    def clear(self):
+        self.cache.clear()
+
+
+class PageCache:
+    """Cache for full pages served to anonymous visitors.
+
+    Entries are keyed by the version of the page's document, which is looked
+    up with a cheap query, so that every process serves the latest page, even
+    with per-process caches. They are stored with an ETag, so that browsers
+    can revalidate the page without it being rendered again.
+
+    """
+
+    def __init__(self, app=None):
+        self.cache = NullCache()
+        self.max_age = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache = make_cache(app.config, "PAGE")
+        self.max_age = app.config.get("PAGE_CACHE_MAX_AGE", 0)
+
+    @staticmethod
+    def key(collection, id_, version):
+        return "page:{}:{}:{}".format(collection, id_, version)
+
+    def get(self, key):
+        """Return the (etag, body) cached for the key, if any."""
+        return self.cache.get(key)
+
+    def set(self, key, etag, body):
+        self.cache.set(key, (etag, body))
+
+    def clear(self):
+        self.cache.clear()
+
+    def make_response(self, etag, body):
+        """Build a cacheable response, that honours If-None-Match."""
+        response = current_app.make_response(body)
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        # Logged in users get a different page for the same URL
+        response.vary.add("Cookie")
+        return response.make_conditional(request)
+
+
+fragment_cache = FragmentCache()
+page_cache = PageCache()
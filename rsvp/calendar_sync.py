@@ -0,0 +1,243 @@
+"""Sync events and birthdays into the shared Google Calendar.
+
+The calendar event last synced for each event or birthday is recorded in
+CalendarEventState, along with a hash of its body, which is also stored in the
+calendar event's extended properties. Syncs compare hashes against these
+records, and only touch the calendar events that have changed. The calendar is
+listed only for a full reconcile, or when there are no records yet.
+
+"""
+
+import datetime
+
+from .gdrive_utils import (
+    cal_event_to_model_id,
+    delete_event,
+    event_hash,
+    execute_calendar_requests,
+    insert_event,
+    list_events,
+    make_birthday_body,
+    make_rsvp_body,
+    update_event,
+)
+from .models import CalendarChange, CalendarEventState, Event
+
+
+def sync_birthdays(service, calendarId, users, full=False):
+    bodies = {user.email: make_birthday_body(user) for user in users}
+    states = CalendarEventState.objects(kind="birthday")
+
+    def calendar_events():
+        for event in list_events(service, calendarId):
+            if event["iCalUID"].startswith("birthday:"):
+                yield event
+
+    if states and not full:
+        calendar_events = None
+    return sync_events(service, calendarId, "birthday", bodies, states, calendar_events)
+
+
+def sync_rsvp_events(service, calendarId, upcoming_rsvps, timezone, today, full=False):
+    start = datetime.datetime.combine(today, datetime.time())
+    # Past events are left alone in the calendar
+    CalendarEventState.objects(kind="rsvp", date__lt=start).delete()
+    bodies, dates = {}, {}
+    for rsvp in upcoming_rsvps:
+        bodies[str(rsvp.id)] = make_rsvp_body(rsvp, timezone)
+        dates[str(rsvp.id)] = rsvp.date
+    states = CalendarEventState.objects(kind="rsvp", date__gte=start)
+
+    def in_future(date_string):
+        return (
+            datetime.datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%SZ").date()
+            >= today
+        )
+
+    def calendar_events():
+        # Events that ended before today aren't listed at all
+        time_min = start.isoformat() + "Z"
+        for event in list_events(service, calendarId, timeMin=time_min):
+            if event["iCalUID"].startswith("rsvp:") and in_future(
+                event["start"]["dateTime"]
+            ):
+                yield event
+
+    if states and not full:
+        calendar_events = None
+    return sync_events(
+        service, calendarId, "rsvp", bodies, states, calendar_events, dates
+    )
+
+
+def sync_events(
+    service, calendarId, kind, bodies, states, calendar_events=None, dates=None
+):
+    """Make the calendar events of a kind match the bodies, keyed by model id.
+
+    ``states`` are the CalendarEventState records of the events in scope. If
+    ``calendar_events``, a function listing the calendar events in scope, is
+    given, the records are rebuilt from the calendar (a full reconcile).
+    Returns the errors, keyed by "<action>:<model id>".
+
+    """
+    dates = dates or {}
+    if calendar_events is not None:
+        synced = {
+            cal_event_to_model_id(event): (event["id"], event_hash(event))
+            for event in calendar_events()
+        }
+        # Records are rebuilt from the calendar
+        states.delete()
+        for model_id, (event_id, hash_) in synced.items():
+            CalendarEventState(
+                key=f"{kind}:{model_id}",
+                kind=kind,
+                event_id=event_id,
+                body_hash=hash_,
+                date=dates.get(model_id),
+            ).save()
+    else:
+        synced = {state.model_id: (state.event_id, state.body_hash) for state in states}
+
+    requests, unchanged = {}, 0
+    for model_id, body in bodies.items():
+        event_id, old_hash = synced.get(model_id, (None, None))
+        if event_id is None:
+            print(f"Adding {body['summary']}...")
+            request = insert_event(service, calendarId, body)
+            requests[f"add:{model_id}"] = request
+        elif old_hash != event_hash(body):
+            print(f"Updating {body['summary']}...")
+            request = update_event(service, calendarId, event_id, body)
+            requests[f"update:{model_id}"] = request
+        else:
+            unchanged += 1
+    for model_id in synced.keys() - bodies.keys():
+        print(f"Deleting {kind} {model_id}...")
+        requests[f"delete:{model_id}"] = delete_event(
+            service, calendarId, synced[model_id][0]
+        )
+    print(f"No update for {unchanged} {kind} events")
+
+    responses, errors = execute_calendar_requests(service, requests)
+    gone = {
+        request_id
+        for request_id, error in errors.items()
+        if getattr(error, "status_code", None) in (404, 410)
+    }
+    for request_id in set(responses) | gone:
+        action, model_id = request_id.split(":", 1)
+        key = f"{kind}:{model_id}"
+        if action == "delete":
+            CalendarEventState.objects(key=key).delete()
+            continue
+        if request_id in gone:
+            # Deleted from the calendar by hand, and re-added next time
+            CalendarEventState.objects(key=key).delete()
+            continue
+        event_id = responses[request_id]["id"]
+        CalendarEventState.objects(key=key).update_one(
+            upsert=True,
+            set__kind=kind,
+            set__event_id=event_id,
+            set__body_hash=event_hash(bodies[model_id]),
+            set__date=dates.get(model_id),
+            set__synced_at=datetime.datetime.now(),
+        )
+    return errors
+
+
+# Changes synced at a time, and the retries for the ones that fail, after which
+# the daily full reconcile fixes the calendar.
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 8
+
+
+def seed_rsvp_states(service, calendarId, keys, dates):
+    """Record the calendar events of upcoming events that have no records.
+
+    Events already on the calendar may have no records, say before the first
+    full reconcile, and would be added again. They are looked up in the
+    calendar around their dates, instead. Deleted events without records are
+    left for the full reconcile to remove.
+
+    """
+    known = set(CalendarEventState.objects(key__in=keys).scalar("key"))
+    missing = {
+        model_id: date
+        for model_id, date in dates.items()
+        if f"rsvp:{model_id}" not in known
+    }
+    if not missing:
+        return
+    # Calendar times are in UTC, so the window is padded by a day either way
+    day = datetime.timedelta(days=1)
+    time_min = datetime.datetime.combine(
+        min(missing.values()).date() - day, datetime.time()
+    )
+    time_max = datetime.datetime.combine(
+        max(missing.values()).date() + 2 * day, datetime.time()
+    )
+    events = list_events(
+        service,
+        calendarId,
+        timeMin=time_min.isoformat() + "Z",
+        timeMax=time_max.isoformat() + "Z",
+    )
+    for event in events:
+        if not event["iCalUID"].startswith("rsvp:"):
+            continue
+        model_id = cal_event_to_model_id(event)
+        if model_id in missing:
+            CalendarEventState(
+                key=f"rsvp:{model_id}",
+                kind="rsvp",
+                event_id=event["id"],
+                body_hash=event_hash(event),
+                date=missing[model_id],
+            ).save()
+
+
+def drain_outbox(service, calendarId, timezone, today):
+    """Sync the events in the outbox of changes. Returns the changes synced."""
+    changes = list(CalendarChange.pending(OUTBOX_BATCH_SIZE))
+    if not changes:
+        return 0
+    # Several changes to an event are synced together, with its current state
+    event_ids = list(dict.fromkeys(change.event_id for change in changes))
+    events = Event.objects.in_bulk(event_ids)
+    start = datetime.datetime.combine(today, datetime.time())
+    bodies, dates = {}, {}
+    for id_, event in events.items():
+        if event.date >= start:
+            bodies[str(id_)] = make_rsvp_body(event, timezone)
+            dates[str(id_)] = event.date
+    # Past events are left alone, but deleted events are removed
+    keys = [f"rsvp:{id_}" for id_ in event_ids if str(id_) in bodies]
+    keys += [f"rsvp:{id_}" for id_ in event_ids if id_ not in events]
+    seed_rsvp_states(service, calendarId, keys, dates)
+    states = CalendarEventState.objects(key__in=keys)
+    errors = sync_events(service, calendarId, "rsvp", bodies, states, dates=dates)
+
+    failed = {
+        request_id.split(":", 1)[1]: error for request_id, error in errors.items()
+    }
+    now = datetime.datetime.now()
+    done = []
+    for change in changes:
+        error = failed.get(str(change.event_id))
+        if error is None:
+            done.append(change.id)
+        elif change.attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+            print(f"Giving up on syncing {change.event_id}: {error}")
+            done.append(change.id)
+        else:
+            backoff = datetime.timedelta(minutes=2**change.attempts)
+            change.update(
+                inc__attempts=1,
+                set__next_attempt_at=now + backoff,
+                set__error=str(error),
+            )
+    CalendarChange.objects(id__in=done).delete()
+    return len(changes)
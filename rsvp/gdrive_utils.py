@@ -1,21 +1,28 @@
 # Standard library
 import datetime
+import hashlib
 import json
 import os
-from itertools import cycle
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import requests
 
 # 3rd party
 from apiclient.discovery import build
-from apiclient.http import MediaIoBaseUpload
+from apiclient.errors import HttpError
+from apiclient.http import HttpRequest, MediaIoBaseUpload, build_http
 from google.oauth2 import credentials as gcredentials
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 
 # Local library
 from .utils import event_absolute_url, random_string
 
 SERVICE_ACCOUNT_FILE = "service_account_file.json"
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
 SCOPES = {
     "drive": ["https://www.googleapis.com/auth/drive"],
     "calendar": ["https://www.googleapis.com/auth/calendar"],
@@ -29,14 +36,53 @@ def download_service_account_file():
         json.dump(requests.get(url).json(), f)
 
 
+# Built services are cached per (account type, API), since building them means
+# parsing a large discovery document. The discovery documents themselves are
+# read from the copies shipped with google-api-python-client, not fetched.
+_services = {}
+_services_lock = threading.Lock()
+
+
+def _thread_local_request_builder(credentials):
+    """Make requests use an HTTP connection per thread.
+
+    httplib2 isn't thread-safe, and this lets a single service object be
+    shared by threads. Credentials are shared too, and the token is refreshed
+    only when it expires.
+
+    """
+    local = threading.local()
+
+    def build_request(http, *args, **kwargs):
+        if not hasattr(local, "http"):
+            local.http = AuthorizedHttp(credentials, http=build_http())
+        return HttpRequest(local.http, *args, **kwargs)
+
+    return build_request
+
+
+def _cached_service(key, name, make_credentials):
+    with _services_lock:
+        if key not in _services:
+            credentials = make_credentials()
+            _services[key] = build(
+                name,
+                "v3",
+                credentials=credentials,
+                requestBuilder=_thread_local_request_builder(credentials),
+            )
+        return _services[key]
+
+
 def create_service(name="drive"):
-    if not os.path.exists(SERVICE_ACCOUNT_FILE):
-        download_service_account_file()
-    credentials = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=SCOPES[name]
-    )
-    service = build(name, "v3", credentials=credentials)
-    return service
+    def make_credentials():
+        if not os.path.exists(SERVICE_ACCOUNT_FILE):
+            download_service_account_file()
+        return service_account.Credentials.from_service_account_file(
+            SERVICE_ACCOUNT_FILE, scopes=SCOPES[name]
+        )
+
+    return _cached_service(("service_account", name), name, make_credentials)
 
 
 def create_oauth_service(name="drive"):
@@ -51,21 +97,24 @@ def create_oauth_service(name="drive"):
 
     """
 
-    credentials = gcredentials.Credentials(
-        token="random-token",
-        refresh_token=os.environ["GDRIVE_REFRESH_TOKEN"],
-        client_id=os.environ["GDRIVE_CLIENT_ID"],
-        client_secret=os.environ["GDRIVE_CLIENT_SECRET"],
-        scopes=SCOPES[name],
-        token_uri="https://www.googleapis.com/oauth2/v4/token",
-    )
-    return build(name, "v3", credentials=credentials)
+    def make_credentials():
+        # No token, so that one is fetched before the first request
+        return gcredentials.Credentials(
+            token=None,
+            refresh_token=os.environ["GDRIVE_REFRESH_TOKEN"],
+            client_id=os.environ["GDRIVE_CLIENT_ID"],
+            client_secret=os.environ["GDRIVE_CLIENT_SECRET"],
+            scopes=SCOPES[name],
+            token_uri="https://www.googleapis.com/oauth2/v4/token",
+        )
+
+    return _cached_service(("oauth", name), name, make_credentials)
 
 
 def create_folder(service, parent, name, description=""):
     metadata = {
         "name": name,
-        "mimeType": "application/vnd.google-apps.folder",
+        "mimeType": FOLDER_MIME_TYPE,
         "description": description,
     }
     if parent is not None:
@@ -116,107 +165,305 @@ def delete_content(service, gdrive_id):
 
 
 def update_permissions(service, file_id, emails):
-    permissions = (
-        service.permissions()
-        .list(fileId=file_id, fields="permissions(id, emailAddress, role)")
-        .execute()
+    """Share the file with exactly the given emails, as writers.
+
+    Owners and service accounts are left alone. Returns a summary of the
+    emails added, removed and the ones that failed.
+
+    """
+    permissions = paginate(
+        service.permissions().list,
+        "permissions",
+        fileId=file_id,
+        fields="nextPageToken, permissions(id, emailAddress, role)",
+        pageSize=100,
     )
+    permissions = [p for p in permissions if "emailAddress" in p]
     permission_emails = {
-        permission["emailAddress"].lower()
-        for permission in permissions.get("permissions", [])
-        if "emailAddress" in permission
+        permission["emailAddress"].lower() for permission in permissions
     }
     delete_permissions = [
         permission
-        for permission in permissions.get("permissions", [])
+        for permission in permissions
         if permission["emailAddress"].lower() not in emails
         and permission["role"] != "owner"
         and "gserviceaccount.com" not in permission["emailAddress"]
     ]
     new_emails = [email for email in emails if email not in permission_emails]
-    print("Adding {} permissions".format(len(new_emails)))
-    print("\n".join(new_emails))
+
+    changes = {}
     for email in new_emails:
         body = {
             "type": "user",
             "role": "writer",
             "emailAddress": email,
-            "sendNotificationEmail": False,
         }
-        service.permissions().create(fileId=file_id, body=body).execute()
-    print("Deleting {} permissions".format(len(delete_permissions)))
-    print("\n".join(permission["emailAddress"] for permission in delete_permissions))
+        changes["add:{}".format(email)] = service.permissions().create(
+            fileId=file_id, body=body, sendNotificationEmail=False
+        )
     for permission in delete_permissions:
-        service.permissions().delete(
-            fileId=file_id, permissionId=permission["id"]
-        ).execute()
-
-
-def photos(service, root):
-    q = "'{}' in parents and mimeType contains 'image/'"
-    for sub_dir in walk_dir(service, root):
-        parent_id = sub_dir[-1]["id"] if isinstance(sub_dir, tuple) else sub_dir["id"]
-        path = (
-            " > ".join(s["name"] for s in sub_dir)
-            if isinstance(sub_dir, tuple)
-            else sub_dir["name"]
+        changes["remove:{}".format(permission["emailAddress"])] = (
+            service.permissions().delete(fileId=file_id, permissionId=permission["id"])
         )
-        photos = (
-            service.files()
-            .list(
-                q=q.format(parent_id),
-                fields="files(id, imageMediaMetadata, thumbnailLink, createdTime)",
-                pageSize=1000,
-            )
-            .execute()["files"]
+    _, errors = execute_batched(service, changes)
+
+    summary = {"added": [], "removed": [], "failed": []}
+    for request_id in changes:
+        action, email = request_id.split(":", 1)
+        if request_id in errors:
+            summary["failed"].append(email)
+        else:
+            summary["added" if action == "add" else "removed"].append(email)
+    for key, emails in summary.items():
+        print("{} {} permissions".format(key.capitalize(), len(emails)))
+        print("\n".join(emails))
+    for request_id, error in errors.items():
+        print("Failed to {}: {}".format(request_id, error))
+    return summary
+
+
+# Google APIs allow up to 100 requests in a batch, but Drive rate limits
+# permission changes aggressively, so fewer requests are sent at a time.
+BATCH_SIZE = 50
+CALENDAR_BATCH_SIZE = 50
+MAX_RETRIES = 5
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+def is_rate_limited(error):
+    if not isinstance(error, HttpError):
+        return False
+    if error.status_code in (429, 500, 502, 503, 504):
+        return True
+    if error.status_code == 403 and isinstance(error.error_details, list):
+        return any(
+            isinstance(detail, dict) and detail.get("reason") in RATE_LIMIT_REASONS
+            for detail in error.error_details
         )
-        yield from [
-            {
-                "gdrive_parent": parent_id,
-                "gdrive_path": path,
-                "gdrive_id": photo["id"],
-                "gdrive_thumbnail": photo["thumbnailLink"],
-                "gdrive_metadata": photo["imageMediaMetadata"],
-                "gdrive_created_at": photo["createdTime"],
-            }
-            for photo in photos
+    return False
+
+
+def execute_batched(service, requests, batch_size=BATCH_SIZE, retries=MAX_RETRIES):
+    """Execute requests (a dict of id -> request) using batch HTTP requests.
+
+    At most ``batch_size`` requests are sent at a time. Requests that are rate
+    limited are retried, with exponential backoff. Returns dicts of the
+    responses and errors, keyed by the request ids.
+
+    """
+    responses, errors = {}, {}
+    pending = dict(requests)
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(min(2**attempt, 32) + random.random())
+        retry = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+                errors.pop(request_id, None)
+                return
+            errors[request_id] = exception
+            if is_rate_limited(exception):
+                retry[request_id] = pending[request_id]
+
+        ids = list(pending)
+        for start in range(0, len(ids), batch_size):
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id in ids[start : start + batch_size]:
+                batch.add(pending[request_id], request_id=request_id)
+            try:
+                batch.execute()
+            except HttpError as e:
+                if not is_rate_limited(e):
+                    raise
+                for request_id in ids[start : start + batch_size]:
+                    errors[request_id] = e
+                    retry[request_id] = pending[request_id]
+        pending = retry
+        if not pending:
+            break
+    return responses, errors
+
+
+# Number of concurrent requests made when crawling the drive
+CRAWL_WORKERS = 8
+PAGE_SIZE = 1000
+
+
+def paginate(method, key, **params):
+    """Yield the items from every page of results of a list method.
+
+    The ``fields`` param, if any, must include ``nextPageToken``.
+
+    """
+    page_token = None
+    while True:
+        page = method(pageToken=page_token, **params).execute()
+        yield from page.get(key, [])
+        page_token = page.get("nextPageToken")
+        if not page_token:
+            break
+
+
+def photos(service, root, workers=CRAWL_WORKERS):
+    """Yield the photos in all the sub-folders of root, as they are found."""
+    for _, folder_photos in folders_with_photos(service, root, workers):
+        yield from folder_photos
+
+
+def folders_with_photos(service, root, workers=CRAWL_WORKERS):
+    """Yield each folder under root, along with the photos in it."""
+    for chain, files in _crawl(service, root, workers, with_photos=True):
+        folder = folder_info(chain, root)
+        photos = [
+            photo_info(photo, folder["gdrive_id"], folder["gdrive_path"])
+            for photo in files
         ]
+        yield folder, photos
+
+
+def folder_info(chain, root):
+    """Folder fields, given the chain of folders from root to it."""
+    return {
+        "gdrive_id": chain[-1]["id"],
+        "name": chain[-1]["name"],
+        "gdrive_parent": chain[-2]["id"] if len(chain) > 1 else root,
+        "gdrive_path": " > ".join(s["name"] for s in chain),
+    }
+
+
+def photo_info(photo, parent_id, path):
+    return {
+        "gdrive_parent": parent_id,
+        "gdrive_path": path,
+        "gdrive_id": photo["id"],
+        "gdrive_thumbnail": photo["thumbnailLink"],
+        "gdrive_metadata": photo["imageMediaMetadata"],
+        "gdrive_created_at": photo["createdTime"],
+    }
+
+
+def list_photos(service, folder_id):
+    q = "'{}' in parents and mimeType contains 'image/' and trashed = false"
+    fields = "nextPageToken, files(id, imageMediaMetadata, thumbnailLink, createdTime)"
+    return list(
+        paginate(
+            service.files().list,
+            "files",
+            q=q.format(folder_id),
+            fields=fields,
+            pageSize=PAGE_SIZE,
+        )
+    )
 
 
 def list_sub_dirs(service, root):
-    q = "'{}' in parents and mimeType='{}'"
-    mime_type = "application/vnd.google-apps.folder"
-    sub_dirs = (
-        service.files()
-        .list(q=q.format(root, mime_type), fields="files(id, name)")
-        .execute()["files"]
+    q = "'{}' in parents and mimeType='{}' and trashed = false"
+    return list(
+        paginate(
+            service.files().list,
+            "files",
+            q=q.format(root, FOLDER_MIME_TYPE),
+            fields="nextPageToken, files(id, name)",
+            pageSize=PAGE_SIZE,
+        )
     )
-    return sub_dirs
+
+
+def folder_tree(service, root, top_level_only=False):
+    """Yield the folders in the root folder, with their parent and path."""
+    if top_level_only:
+        chains = ((sub_dir,) for sub_dir in list_sub_dirs(service, root))
+    else:
+        chains = walk_dir(service, root)
+    for chain in chains:
+        yield folder_info(chain, root)
 
 
 def list_files(service, folder_id):
     q = "'{}' in parents"
-    files = (
-        service.files()
-        .list(q=q.format(folder_id), fields="files(id, name)")
-        .execute()["files"]
+    return list(
+        paginate(
+            service.files().list,
+            "files",
+            q=q.format(folder_id),
+            fields="nextPageToken, files(id, name)",
+            pageSize=PAGE_SIZE,
+        )
     )
-    return files
 
 
-def flat_zip(x, y):
-    if isinstance(y, tuple):
-        return (x, *y)
+CHANGE_FIELDS = (
+    "nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, "
+    "mimeType, parents, trashed, imageMediaMetadata, thumbnailLink, createdTime))"
+)
 
-    return (x, y)
 
+def get_start_page_token(service):
+    """Token to list the changes made in the drive from now on."""
+    token = service.changes().getStartPageToken(supportsAllDrives=True).execute()
+    return token["startPageToken"]
 
-def walk_dir(service, root):
-    sub_dirs = list_sub_dirs(service, root)
-    yield from sub_dirs
 
-    for sub_dir in sub_dirs:
-        yield from map(flat_zip, cycle([sub_dir]), walk_dir(service, sub_dir["id"]))
+def list_changes(service, page_token):
+    """Return the changes since page_token, and the token for the next call."""
+    changes = []
+    while True:
+        page = (
+            service.changes()
+            .list(
+                pageToken=page_token,
+                fields=CHANGE_FIELDS,
+                pageSize=PAGE_SIZE,
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True,
+            )
+            .execute()
+        )
+        changes.extend(page.get("changes", []))
+        if "newStartPageToken" in page:
+            return changes, page["newStartPageToken"]
+        page_token = page["nextPageToken"]
+
+
+def walk_dir(service, root, workers=CRAWL_WORKERS):
+    """Yield all the folders under root, as tuples of folders starting at root."""
+    for chain, _ in _crawl(service, root, workers):
+        yield chain
+
+
+def _crawl(service, root, workers, with_photos=False):
+    """Crawl the folders under root, listing folders concurrently.
+
+    Yields (chain, photos) pairs for each folder, where chain is the tuple of
+    folders leading to it from root. photos is None, unless ``with_photos``
+    is set. Folders are yielded level by level, as their listings complete.
+
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+
+        def submit(list_func, chain, folder_id):
+            future = pool.submit(list_func, service, folder_id)
+            pending[future] = (list_func, chain)
+
+        submit(list_sub_dirs, (), root)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                list_func, chain = pending.pop(future)
+                if list_func is list_photos:
+                    yield chain, future.result()
+                    continue
+
+                for sub_dir in future.result():
+                    sub_chain = chain + (sub_dir,)
+                    submit(list_sub_dirs, sub_chain, sub_dir["id"])
+                    if with_photos:
+                        submit(list_photos, sub_chain, sub_dir["id"])
+                    else:
+                        yield sub_chain, None
 
 
 # Calendar
@@ -291,55 +538,87 @@ def generate_calendar_event_id(obj, type_):
     return "{prefix}:{key}:{suffix}".format(prefix=type_, key=key, suffix=suffix)
 
 
-def delete_calendar_event(service, calendarId, iCalUID):
-    events = (
-        service.events().list(calendarId=calendarId, iCalUID=iCalUID).execute()["items"]
-    )
-    if len(events) == 1:
-        event = events[0]
-        service.events().delete(calendarId=calendarId, eventId=event["id"]).execute()
-    else:
-        print("Event not found: {}".format(iCalUID))
+# Private extended property of calendar events, with a hash of their content
+HASH_PROPERTY = "rsvpHash"
 
 
-def _event_needs_update(existing, new):
-    for key, value in new.items():
-        if key == "iCalUID":
-            continue
-        if key not in existing or existing[key] != value:
-            return True
-    return False
+def body_hash(body):
+    content = {
+        key: value
+        for key, value in body.items()
+        if key not in ("iCalUID", "extendedProperties")
+    }
+    content = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def with_body_hash(body):
+    """Add the hash of the body to its extended properties."""
+    body["extendedProperties"] = {"private": {HASH_PROPERTY: body_hash(body)}}
+    return body
+
 
+def event_hash(event):
+    """Hash of the body that a calendar event was created with, if any."""
+    properties = event.get("extendedProperties", {}).get("private", {})
+    return properties.get(HASH_PROPERTY)
 
-def list_events(service, calendarId):
-    events = service.events().list(calendarId=calendarId, maxResults=2500).execute()
-    event_items = events["items"]
-    while "nextPageToken" in events:
-        events = service.events().list(calendarId=calendarId, maxResults=2500).execute()
-        event_items = events["items"] + event_items
-    return event_items
+
+def event_pages(service, calendarId, **params):
+    """Yield the pages of events in the calendar.
+
+    Other list parameters are passed through. Times, like ``timeMin``, are
+    RFC3339 strings with an offset, e.g., "2026-01-01T00:00:00Z". With a
+    ``syncToken`` (the ``nextSyncToken`` of the last page of an earlier
+    listing), only events changed since then are listed, including deleted
+    ones, with status "cancelled". Google responds with a 410 error if the
+    token has expired, and a full listing is needed.
+
+    """
+    page_token = None
+    while True:
+        page = (
+            service.events()
+            .list(
+                calendarId=calendarId,
+                maxResults=2500,
+                pageToken=page_token,
+                **params,
+            )
+            .execute()
+        )
+        yield page
+        page_token = page.get("nextPageToken")
+        if not page_token:
+            break
+
+
+def list_events(service, calendarId, **params):
+    """Yield the events in the calendar, fetching pages as needed."""
+    for page in event_pages(service, calendarId, **params):
+        yield from page.get("items", [])
 
 
 def cal_event_to_model_id(event):
     return event["iCalUID"].split(":", 2)[1]
 
 
-def add_birthday(service, calendarId, user):
-    body = make_birthday_body(user)
-    print(f"Adding {body['summary']}...")
-    service.events().insert(calendarId=calendarId, body=body).execute()
+# The insert/update/delete functions below return the requests to be made,
+# which are executed together by execute_calendar_requests.
 
 
-def update_birthday(service, calendarId, user, event):
-    body = make_birthday_body(user)
-    title = body["summary"]
-    if not _event_needs_update(event, body):
-        print(f"No update for {title}")
-    else:
-        print(f"Updating {title}")
-        service.events().update(
-            calendarId=calendarId, eventId=event["id"], body=body
-        ).execute()
+def insert_event(service, calendarId, body):
+    return service.events().insert(calendarId=calendarId, body=body)
+
+
+def update_event(service, calendarId, eventId, body):
+    # Events keep the iCalUID they were created with
+    body = {key: value for key, value in body.items() if key != "iCalUID"}
+    return service.events().update(calendarId=calendarId, eventId=eventId, body=body)
+
+
+def delete_event(service, calendarId, eventId):
+    return service.events().delete(calendarId=calendarId, eventId=eventId)
 
 
 def make_birthday_body(user):
@@ -354,12 +633,7 @@ def make_birthday_body(user):
         "summary": title,
         "iCalUID": iCalUID,
     }
-    return body
-
-
-def delete_event(service, calendarId, event):
-    print(f"Deleting {event['summary']}...")
-    delete_calendar_event(service, calendarId, event["iCalUID"])
+    return with_body_hash(body)
 
 
 def make_rsvp_body(rsvp, timezone):
@@ -380,22 +654,15 @@ def make_rsvp_body(rsvp, timezone):
             "title": "Go to RSVP app page",
         },
     }
-    return body
-
-
-def add_rsvp(service, calendarId, rsvp, timezone):
-    body = make_rsvp_body(rsvp, timezone)
-    print(f"Adding {body['summary']}...")
-    service.events().insert(calendarId=calendarId, body=body).execute()
+    return with_body_hash(body)
 
 
-def update_rsvp(service, calendarId, rsvp, event, timezone):
-    body = make_rsvp_body(rsvp, timezone)
-    title = body["summary"]
-    if not _event_needs_update(event, body):
-        print(f"No update for {title}")
-    else:
-        print(f"Updating {title}")
-        service.events().update(
-            calendarId=calendarId, eventId=event["id"], body=body
-        ).execute()
+def execute_calendar_requests(service, requests):
+    """Execute the requests (a dict of id -> request) in batches."""
+    responses, errors = execute_batched(
+        service, requests, batch_size=CALENDAR_BATCH_SIZE
+    )
+    for request_id, error in errors.items():
+        print("Failed to {}: {}".format(request_id, error))
+    print("Made {} calendar changes".format(len(responses)))
+    return responses, errors
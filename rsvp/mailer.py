@@ -0,0 +1,247 @@
+"""Emails are queued in an outbox collection, and sent in the background.
+
+The worker sends them over a small pool of SMTP connections, which are kept
+open and reused while there are emails to send. Emails that fail are retried later,
+with exponential backoff.
+
+"""
+
+import datetime
+import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from .models import OutboxEmail
+
+MAX_ATTEMPTS = 6
+# Emails claimed by a worker that died before sending them are retried after
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+# Seconds between checks for emails due to be retried
+POLL_INTERVAL = 60
+
+
+def queue_email(to_users, subject, body):
+    """Queue an email to each user, and return right away."""
+    return queue_emails((user, subject, body) for user in to_users)
+
+
+def queue_emails(messages):
+    """Queue personalized emails, given as (user, subject, body) tuples."""
+    now = datetime.datetime.now()
+    emails = [
+        OutboxEmail(
+            to=user.email,
+            subject=subject,
+            body=body,
+            created_at=now,
+            next_attempt_at=now,
+        )
+        for user, subject, body in messages
+    ]
+    if emails:
+        OutboxEmail.objects.insert(emails, load_bulk=False)
+        mail_worker.notify()
+    return len(emails)
+
+
+class SMTPConnection:
+    """An SMTP connection, opened when first needed and reused after."""
+
+    def __init__(self, host, port, from_email, user=None, password=None, starttls=True):
+        self.host = host
+        self.port = port
+        self.from_email = from_email
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.server = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config["SMTP_HOST"],
+            config["SMTP_PORT"],
+            config["FROM_EMAIL"],
+            user=config.get("SMTP_USER"),
+            password=config.get("SMTP_PASSWORD"),
+            starttls=config.get("SMTP_STARTTLS", True),
+        )
+
+    def open(self):
+        if self.server is not None:
+            return
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            if self.starttls:
+                server.starttls()
+            if self.user:
+                server.login(self.user, self.password)
+        except smtplib.SMTPException:
+            server.close()
+            raise
+        self.server = server
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except smtplib.SMTPException:
+            self.server.close()
+        self.server = None
+
+    def send(self, to, subject, body):
+        msg = MIMEMultipart()
+        msg["Subject"] = subject
+        msg["From"] = self.from_email
+        msg["To"] = to
+        msg.attach(MIMEText(body, "plain"))
+        try:
+            self.open()
+            self.server.sendmail(self.from_email, [to], msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+            # Servers drop idle connections, so try again on a new one
+            self.server, server = None, self.server
+            try:
+                server.close()
+            except OSError:
+                pass
+            self.open()
+            self.server.sendmail(self.from_email, [to], msg.as_string())
+
+
+def claim_email():
+    """Claim the next email due to be sent, so that no other worker sends it."""
+    now = datetime.datetime.now()
+    return (
+        OutboxEmail.objects(next_attempt_at__lte=now)
+        .order_by("next_attempt_at", "created_at")
+        .modify(
+            inc__attempts=1,
+            set__next_attempt_at=now + CLAIM_TIMEOUT,
+            new=True,
+        )
+    )
+
+
+def send_pending(connection):
+    """Send the emails that are due, and return the number sent."""
+    sent = 0
+    while True:
+        email = claim_email()
+        if email is None:
+            return sent
+        try:
+            connection.send(email.to, email.subject, email.body)
+        except smtplib.SMTPRecipientsRefused as e:
+            retry_later(email, e)
+        except (smtplib.SMTPException, OSError) as e:
+            connection.close()
+            retry_later(email, e)
+            # The server is unreachable, and later emails would fail too
+            return sent
+        else:
+            email.delete()
+            sent += 1
+
+
+def retry_later(email, error):
+    if email.attempts >= MAX_ATTEMPTS:
+        print("Giving up sending email to {}: {}".format(email.to, error))
+        email.delete()
+        return
+    backoff = datetime.timedelta(minutes=2**email.attempts)
+    email.update(
+        set__next_attempt_at=datetime.datetime.now() + backoff,
+        set__error=str(error),
+    )
+
+
+def send_all(app, connections):
+    """Send the emails that are due over the connections, concurrently."""
+
+    def send(connection):
+        with app.app_context():
+            return send_pending(connection)
+
+    if len(connections) == 1:
+        return send(connections[0])
+    with ThreadPoolExecutor(len(connections)) as pool:
+        return sum(pool.map(send, connections))
+
+
+def make_connections(config):
+    n = config.get("SMTP_MAX_CONNECTIONS", 1)
+    return [SMTPConnection.from_config(config) for _ in range(n)]
+
+
+class MailWorker:
+    """Thread that sends the queued emails, woken up when emails are queued.
+
+    The thread is started by the web server processes, and also polls for the
+    emails that are due to be retried. Other processes only queue emails, which
+    are sent by the web server, or by the cron job that drains the outbox.
+
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("EMAIL_WORKER", False)
+
+    def start(self):
+        """Start the thread, which first sends the emails already pending."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        connections = make_connections(self.app.config)
+        while not self._stopped.is_set():
+            try:
+                send_all(self.app, connections)
+            except Exception as e:
+                print("Error sending emails: {}".format(e))
+            # Keep the connections open only while emails keep coming
+            if not self._wakeup.wait(POLL_INTERVAL):
+                for connection in connections:
+                    connection.close()
+            self._wakeup.clear()
+        for connection in connections:
+            connection.close()
+
+    def flush(self):
+        """Send the pending emails from this thread, e.g., from a script."""
+        connections = make_connections(self.app.config)
+        try:
+            return send_all(self.app, connections)
+        finally:
+            for connection in connections:
+                connection.close()
+
+
+mail_worker = MailWorker()
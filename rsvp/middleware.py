@@ -0,0 +1,23 @@
+from werkzeug.utils import redirect
+from werkzeug.wsgi import get_current_url
+
+
+class LegacyHostRedirect:
+    """WSGI middleware to redirect requests for old hosts to the current one.
+
+    Only the Host header is looked up in a set of legacy hosts, so requests
+    for the current host go straight through to the app.
+
+    """
+
+    def __init__(self, app, canonical_host, legacy_hosts):
+        self.app = app
+        self.canonical_host = canonical_host
+        self.legacy_hosts = frozenset(legacy_hosts)
+
+    def __call__(self, environ, start_response):
+        if environ.get("HTTP_HOST") not in self.legacy_hosts:
+            return self.app(environ, start_response)
+
+        url = get_current_url(dict(environ, HTTP_HOST=self.canonical_host))
+        return redirect(url, code=301)(environ, start_response)
@@ -1,27 +1,121 @@
 import datetime
+import random
+import time
 from urllib.parse import quote, urlencode
 
+from blinker import Namespace
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 from flask import url_for
 from flask_login import UserMixin, AnonymousUserMixin
 from flask_mongoengine import MongoEngine
 from mongoengine import signals
-
-from .utils import random_id, markdown_to_html, read_app_config, format_date
-
+from mongoengine.errors import NotUniqueError
+from pymongo import UpdateMany, UpdateOne
+from mongoengine.queryset.visitor import Q
+
+from .cache import fragment_cache, invalidate_profiles
+from .utils import (
+    format_date,
+    html_excerpt,
+    markdown_to_html,
+    mongo_now,
+    random_id,
+    read_app_config,
+)
 
 db = MongoEngine()
 ANONYMOUS_EMAIL = "anonymous@example.com"
+# RSVPs of users other than the anonymous user, who can RSVP many times
+NAMED_USERS = {
+    "$or": [{"user": {"$lt": ANONYMOUS_EMAIL}}, {"user": {"$gt": ANONYMOUS_EMAIL}}]
+}
+# Sent with the RSVPs that got a spot, when an event's waitlist is updated, after
+# they are recorded as WaitlistPromotions
+waitlist_promoted = Namespace().signal("waitlist-promoted")
+# Attempts at updating an event's waitlist, when RSVPs are made concurrently,
+# after which the update is left to the next one, or to the cron job
+WAITLIST_ATTEMPTS = 5
+
+
+class RSVP(db.Document):
+    """An RSVP to an event.
+
+    RSVPs are kept in their own collection, rather than in the event, so that
+    they can be written one at a time, and events with many RSVPs stay small.
+    Writes to an event's RSVPs must bump the event's version.
 
+    """
 
-class RSVP(db.EmbeddedDocument):
     id = db.ObjectIdField(default=random_id, primary_key=True)
+    event = db.LazyReferenceField("Event", required=True)
     user = db.LazyReferenceField("User", unique=False)
     note = db.StringField()
     date = db.DateTimeField(required=True, default=datetime.datetime.now)
     rsvp_by = db.LazyReferenceField("User")
     cancelled = db.BooleanField(default=False)
     waitlisted = db.BooleanField(default=False)
-    meta = {"strict": False}
+    meta = {
+        "collection": "rsvp",
+        "indexes": [
+            # A user can RSVP to an event only once (needs MongoDB 6.0+)
+            {
+                "fields": ("event", "user"),
+                "unique": True,
+                "partialFilterExpression": NAMED_USERS,
+            },
+            ("event", "cancelled", "waitlisted", "date"),
+        ],
+        "strict": False,
+    }
+
+    @classmethod
+    def active_counts(cls, event_ids):
+        """Return the number of active RSVPs of each of the events."""
+        counts = cls.objects.aggregate(
+            {
+                "$match": {
+                    "event": {"$in": list(event_ids)},
+                    "cancelled": False,
+                    "waitlisted": False,
+                }
+            },
+            {"$group": {"_id": "$event", "count": {"$sum": 1}}},
+        )
+        return {count["_id"]: count["count"] for count in counts}
+
+    @classmethod
+    def move_to_user(cls, user, canonical_user):
+        """Move a user's RSVPs to another user, e.g., when merging accounts.
+
+        Where both users RSVPed to an event, the one RSVP that isn't cancelled,
+        or else the earlier one, is kept for the other user. Return the RSVPs
+        deleted.
+
+        """
+        rsvps = list(cls.objects(user=user))
+        events = [rsvp.event.pk for rsvp in rsvps]
+        existing = {
+            rsvp.event.pk: rsvp
+            for rsvp in cls.objects(user=canonical_user, event__in=events)
+        }
+        deleted = []
+        for rsvp in rsvps:
+            other = existing.get(rsvp.event.pk)
+            if other is not None:
+                keep, drop = sorted((rsvp, other), key=lambda r: (r.cancelled, r.date))
+                drop.delete()
+                deleted.append(drop)
+                if keep is other:
+                    continue
+            rsvp.update(user=canonical_user)
+        # RSVPs are shown with their users' names
+        for event in set(events):
+            Event.objects(id=event).update_one(inc__version=1)
+        # The deleted RSVPs may have held spots
+        for event in Event.objects(id__in=[rsvp.event.pk for rsvp in deleted]):
+            event.update_waitlist()
+        return deleted
 
     def can_cancel(self, user):
         return user == self.rsvp_by or user == self.user or self.rsvp_by is None
@@ -31,8 +125,47 @@ class RSVP(db.EmbeddedDocument):
         return (self.cancelled, self.waitlisted, self.date)
 
 
+class RSVPPartition:
+    """An event's RSVPs split into active, waitlisted and cancelled ones.
+
+    Each part is sorted by date. ``all`` has the active RSVPs first, then the
+    waitlisted, and then the cancelled ones. The users are loaded together,
+    the first time any of them is needed.
+
+    """
+
+    __slots__ = ("active", "waitlisted", "cancelled", "all", "_users")
+
+    def __init__(self, rsvps):
+        self.active, self.waitlisted, self.cancelled = [], [], []
+        for rsvp in rsvps:
+            if rsvp.cancelled:
+                self.cancelled.append(rsvp)
+            elif rsvp.waitlisted:
+                self.waitlisted.append(rsvp)
+            else:
+                self.active.append(rsvp)
+        self.all = self.active + self.waitlisted + self.cancelled
+        self._users = None
+
+    @property
+    def non_cancelled(self):
+        return self.all[: len(self.active) + len(self.waitlisted)]
+
+    @property
+    def users(self):
+        if self._users is None:
+            self._users = User.objects.in_bulk(list({r.user.pk for r in self.all}))
+        return self._users
+
+    def user(self, rsvp):
+        return self.users[rsvp.user.pk]
+
+    def with_gender(self, gender):
+        return [r for r in self.active if self.user(r).gender == gender]
+
+
 class Event(db.Document):
-    rsvps = db.EmbeddedDocumentListField(RSVP)
     rsvp_limit = db.IntField(default=0)
     name = db.StringField(required=True)
     description = db.StringField()
@@ -44,25 +177,141 @@ class Event(db.Document):
     created_by = db.LazyReferenceField("User")
     cancelled = db.BooleanField(required=True, default=False)
     gdrive_id = db.StringField()
+    version = db.IntField(default=0)
+    # Set when an update of the waitlist gave up, for the cron job to redo it
+    waitlist_outdated = db.BooleanField(default=False)
     meta = {
         "indexes": [{"fields": ["$name", "$description"]}],  # text index
         "strict": False,
     }
 
+    FRAGMENTS = ("event-header",)
+    # Fields shown in the calendar, changes to which are queued for syncing
+    CALENDAR_FIELDS = {
+        "name",
+        "description",
+        "date",
+        "_end_date",
+        "cancelled",
+        "archived",
+    }
+
     @classmethod
     def pre_save(cls, sender, document, **kwargs):
+        fragment_cache.invalidate(document, cls.FRAGMENTS)
+        changed = set(document._get_changed_fields())
+        document._calendar_changed = document._created or bool(
+            changed & cls.CALENDAR_FIELDS
+        )
+        if document._created:
+            document.version = 1
         document.html_description = markdown_to_html(document.description)
 
+    @classmethod
+    def post_save(cls, sender, document, created, **kwargs):
+        if not created:
+            # RSVPs may have bumped the version since the event was loaded, so
+            # setting it from the loaded value could move it backwards
+            event = Event.objects(pk=document.pk).modify(inc__version=1, new=True)
+            if event is not None:
+                document.version = event.version
+                document._clear_changed_fields()
+        if getattr(document, "_calendar_changed", False):
+            CalendarChange.add([document.pk], "save")
+
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        RSVP.objects(event=document).delete()
+        CalendarChange.add([document.pk], "delete")
+
+    @classmethod
+    def archive_ended(cls, now=None):
+        """Archive the events that have ended, and unarchive the others.
+
+        Events without an end date end ``EVENT_DURATION`` after they start,
+        like ``end_date``. Only events with an end date still to come are
+        unarchived, so that upcoming events archived by hand stay archived.
+        Only the events whose archived state changes are written. Return the
+        ids of the changed events.
+
+        """
+        now = now or datetime.datetime.now()
+        duration = datetime.timedelta(seconds=read_app_config()["EVENT_DURATION"])
+        ended = Q(_end_date__lt=now) | Q(_end_date=None, date__lt=now - duration)
+        not_ended = Q(_end_date__gte=now)
+        changed = cls.objects(
+            (ended & Q(archived__ne=True)) | (not_ended & Q(archived=True))
+        ).scalar("id", "archived")
+        to_archive = [id_ for id_, archived in changed if not archived]
+        to_unarchive = [id_ for id_, archived in changed if archived]
+        requests = [
+            # Bump the version, since cached event headers show the archived state
+            UpdateMany(
+                {"_id": {"$in": ids}, "archived": {"$ne": archived}},
+                {"$set": {"archived": archived}, "$inc": {"version": 1}},
+            )
+            for ids, archived in ((to_archive, True), (to_unarchive, False))
+            if ids
+        ]
+        if requests:
+            cls._get_collection().bulk_write(requests, ordered=False)
+        return to_archive + to_unarchive
+
+    @classmethod
+    def cancelled_without_rsvps(cls):
+        """Return the ids and names of cancelled events with no active RSVPs."""
+        events = cls.objects.aggregate(
+            {"$match": {"cancelled": True}},
+            {
+                "$lookup": {
+                    "from": RSVP._get_collection_name(),
+                    "localField": "_id",
+                    "foreignField": "event",
+                    "as": "rsvps",
+                }
+            },
+            {
+                "$match": {
+                    "rsvps": {
+                        "$not": {
+                            "$elemMatch": {
+                                "cancelled": {"$ne": True},
+                                "waitlisted": {"$ne": True},
+                            }
+                        }
+                    }
+                }
+            },
+            {"$project": {"name": 1}},
+        )
+        return [(event["_id"], event["name"]) for event in events]
+
+    @classmethod
+    def bulk_delete(cls, ids):
+        """Delete events and their RSVPs, without loading the events."""
+        cls._get_collection().delete_many({"_id": {"$in": ids}})
+        RSVP.objects(event__in=ids).delete()
+        # The events aren't loaded, so no signals are sent for them
+        CalendarChange.add(ids, "delete")
+
+    @property
+    def rsvps(self):
+        return RSVP.objects(event=self)
+
+    @property
+    def rsvp_partition(self):
+        """The RSVPs by state, loaded once until they are changed."""
+        if getattr(self, "_rsvp_partition", None) is None:
+            self._rsvp_partition = RSVPPartition(self.rsvps.order_by("date", "id"))
+        return self._rsvp_partition
+
     @property
     def active_rsvps(self):
-        return sorted(
-            self.rsvps.filter(cancelled=False, waitlisted=False),
-            key=lambda x: x.sort_attributes,
-        )
+        return self.rsvp_partition.active
 
     @property
     def all_rsvps(self):
-        return sorted(self.rsvps, key=lambda x: x.sort_attributes)
+        return self.rsvp_partition.all
 
     @property
     def end_date(self):
@@ -74,13 +323,52 @@ class Event(db.Document):
 
     @property
     def non_cancelled_rsvps(self):
-        return sorted(
-            self.rsvps.filter(cancelled=False), key=lambda x: x.sort_attributes
+        return self.rsvp_partition.non_cancelled
+
+    def add_rsvp(self, rsvp):
+        """Add an RSVP, unless the user has already RSVPed.
+
+        Return the user's existing RSVP, or None if the RSVP was added.
+
+        """
+        rsvp.event = self
+        if rsvp.user.pk == ANONYMOUS_EMAIL:
+            rsvp.save(force_insert=True)
+            existing = None
+        else:
+            # An upsert, so that concurrent requests can't add two RSVPs
+            rsvps = RSVP.objects(event=self, user=rsvp.user)
+            try:
+                existing = rsvps.modify(
+                    upsert=True, __raw__={"$setOnInsert": rsvp.to_mongo()}
+                )
+            except NotUniqueError:
+                # Concurrent upserts can both insert, and the unique index
+                # fails all but one of them
+                existing = rsvps.get()
+        if existing is None:
+            self.update(inc__version=1)
+            self._rsvp_partition = None
+        return existing
+
+    def update_rsvp(self, rsvp, **fields):
+        """Update the fields of an RSVP, and bump the event's version."""
+        RSVP.objects(id=rsvp.id).update_one(
+            **{"set__{}".format(key): value for key, value in fields.items()}
         )
+        self.update(inc__version=1)
+        self._rsvp_partition = None
+        for key, value in fields.items():
+            setattr(rsvp, key, value)
+
+    def delete_rsvp(self, rsvp):
+        RSVP.objects(id=rsvp.id).delete()
+        self.update(inc__version=1)
+        self._rsvp_partition = None
 
     @property
     def rsvp_count(self):
-        return len(self.active_rsvps)
+        return len(self.rsvp_partition.active)
 
     @property
     def title(self):
@@ -99,11 +387,15 @@ class Event(db.Document):
         return url_for("event", id=self.id)
 
     def rsvps_with_gender(self, gender):
-        return [r for r in self.active_rsvps if r.user.fetch().gender == gender]
+        return self.rsvp_partition.with_gender(gender)
+
+    def reload(self, *fields, **kwargs):
+        self._rsvp_partition = None
+        return super().reload(*fields, **kwargs)
 
     def can_edit(self, user):
         return user.is_admin or (
-            self.created_by and self.created_by.fetch().email == user.email
+            self.created_by is not None and self.created_by.id == user.email
         )
 
     def can_rsvp(self, user):
@@ -112,13 +404,131 @@ class Event(db.Document):
 
         return not (self.archived or self.cancelled)
 
+    def waitlist_changes(self):
+        """Return the RSVPs whose waitlisted flag needs to be flipped.
+
+        RSVPs get a spot in the order in which they were made, with ties broken
+        by their ids, so that every request computes the same waitlist.
+
+        """
+        rsvps = self.rsvps.filter(cancelled=False).order_by("date", "id")
+        return [
+            rsvp
+            for i, rsvp in enumerate(rsvps)
+            if rsvp.waitlisted != (0 < self.rsvp_limit <= i)
+        ]
+
     def update_waitlist(self):
-        for i, rsvp in enumerate(self.non_cancelled_rsvps):
-            rsvp.waitlisted = i >= self.rsvp_limit if self.rsvp_limit > 0 else False
-        self.save()
+        """Recompute the waitlist, without clobbering concurrent RSVPs.
+
+        The waitlist is only written if the event's version is unchanged since
+        the RSVPs were read, and is recomputed otherwise. It is also recomputed
+        if the version changed while it was being written, since a concurrent
+        update could have read the RSVPs before this one's changes landed.
+
+        After ``WAITLIST_ATTEMPTS``, requests stop waiting, and the event is
+        marked outdated, for the cron job to update the waitlist, unless
+        another update settles it first. Returns whether the waitlist was
+        settled. Promotions are signalled either way, for the RSVPs still
+        holding their spots.
+
+        """
+        promoted = set()
+        settled = False
+        for attempt in range(WAITLIST_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(random.uniform(0, 0.01 * 2**attempt))
+            self.reload("rsvp_limit", "version", "waitlist_outdated")
+            version = self.version
+            changed = self.waitlist_changes()
+            if not changed:
+                settled = True
+                break
+            if not Event.objects(pk=self.pk, version=version).update_one(
+                inc__version=1
+            ):
+                continue
+            self.version += 1
+            for waitlisted in (True, False):
+                ids = [r.id for r in changed if r.waitlisted != waitlisted]
+                if ids:
+                    RSVP.objects(id__in=ids).update(set__waitlisted=waitlisted)
+            for rsvp in changed:
+                if rsvp.waitlisted:
+                    promoted.add(rsvp.id)
+                else:
+                    promoted.discard(rsvp.id)
+            if Event.objects(pk=self.pk, version=self.version).count():
+                settled = True
+                break
+        if settled and self.waitlist_outdated:
+            Event.objects(pk=self.pk).update_one(set__waitlist_outdated=False)
+        elif not settled:
+            print("Gave up updating the waitlist of {}".format(self.pk))
+            Event.objects(pk=self.pk).update_one(set__waitlist_outdated=True)
+        self.waitlist_outdated = not settled
+        self._rsvp_partition = None
+        self._clear_changed_fields()
+        if promoted:
+            # Concurrent updates could have waitlisted them again
+            rsvps = RSVP.objects(id__in=list(promoted), waitlisted=False)
+            rsvps = list(rsvps.filter(cancelled=False).order_by("date", "id"))
+            if rsvps:
+                WaitlistPromotion.add(self.pk, [rsvp.id for rsvp in rsvps])
+                waitlist_promoted.send(self, rsvps=rsvps)
+        return settled
 
 
 signals.pre_save.connect(Event.pre_save, sender=Event)
+signals.post_save.connect(Event.post_save, sender=Event)
+signals.post_delete.connect(Event.post_delete, sender=Event)
+
+
+class EventSummary:
+    """Immutable snapshot of an event, with what the event lists show."""
+
+    __slots__ = ("id", "name", "cancelled", "rsvp_count", "weekday", "day", "url")
+
+    # Summaries of the upcoming events, with the ids and versions they are of
+    _upcoming = (None, ())
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("EventSummary is immutable")
+
+    @classmethod
+    def upcoming(cls):
+        """Return the summaries of the events that aren't archived, by date.
+
+        They are rebuilt only when the events have changed. Any change to an
+        event, including to its RSVPs, bumps its version, so only the ids and
+        versions are queried otherwise.
+
+        """
+        events = Event.objects(archived=False).order_by("date")
+        key = tuple(events.scalar("id", "version"))
+        cached_key, summaries = cls._upcoming
+        if key != cached_key:
+            fields = events.only("name", "date", "cancelled").as_pymongo()
+            events = list(fields)
+            counts = RSVP.active_counts([event["_id"] for event in events])
+            summaries = tuple(
+                cls(
+                    id=event["_id"],
+                    name=event["name"],
+                    cancelled=event.get("cancelled", False),
+                    rsvp_count=counts.get(event["_id"], 0),
+                    weekday=event["date"].strftime("%a"),
+                    day=event["date"].strftime("%d %b"),
+                    url=url_for("event", id=event["_id"]),
+                )
+                for event in events
+            )
+            cls._upcoming = (key, summaries)
+        return summaries
 
 
 class User(db.Document, UserMixin):
@@ -165,6 +575,24 @@ class User(db.Document, UserMixin):
     def is_anonymous_user(self):
         return self.email == ANONYMOUS_EMAIL
 
+    @classmethod
+    def pre_save(cls, sender, document, **kwargs):
+        changed = set(document._get_changed_fields())
+        document._profile_changed = not document._created and bool(
+            changed & {"name", "nick"}
+        )
+
+    @classmethod
+    def post_save(cls, sender, document, created, **kwargs):
+        # Names are shown in cached bylines, event headers and pages, which are
+        # missed once the new names are saved
+        if getattr(document, "_profile_changed", False):
+            invalidate_profiles()
+
+
+signals.pre_save.connect(User.pre_save, sender=User)
+signals.post_save.connect(User.post_save, sender=User)
+
 
 class AnonymousUser(AnonymousUserMixin):
     email = None
@@ -184,26 +612,74 @@ class Post(db.Document):
     title = db.StringField(required=True)
     content = db.StringField()
     html_content = db.StringField()
+    excerpt = db.StringField()
     created_at = db.DateTimeField(required=True, default=datetime.datetime.now)
     archived = db.BooleanField(default=False)
     authors = db.ListField(db.ReferenceField("User"))
     public = db.BooleanField(default=False)
     draft = db.BooleanField(default=False)
+    version = db.IntField(default=0)
+    meta = {"indexes": [("-created_at", "-id")]}
+
+    FRAGMENTS = ("post-byline", "post-body")
+
+    # Fields needed to list posts, without their (potentially large) bodies
+    SUMMARY_FIELDS = ("title", "authors", "created_at", "excerpt", "public", "draft")
 
     @classmethod
     def pre_save(cls, sender, document, **kwargs):
         # If a document is a draft, turn off the public flag
         if document.draft:
             document.public = False
+        fragment_cache.invalidate(document, cls.FRAGMENTS)
+        document.version = (document.version or 0) + 1
         document.html_content = markdown_to_html(document.content)
+        document.excerpt = html_excerpt(document.html_content)
+
+    @property
+    def cursor(self):
+        """Pagination cursor pointing at this post."""
+        return "{}_{}".format(self.created_at.isoformat(), self.id)
+
+    @classmethod
+    def page(cls, posts, before=None, limit=20, full=False):
+        """Return a page of ``posts``, newest first, and the next page's cursor.
+
+        Uses keyset pagination on (created_at, id), so fetching an old page
+        costs the same as fetching the first one. ``before`` is the cursor of
+        the last post on the previous page. Only the summary fields are loaded,
+        unless ``full`` is set. Raises ValueError for malformed cursors.
+
+        """
+        if before:
+            created_at, id_ = before.rsplit("_", 1)
+            created_at = datetime.datetime.fromisoformat(created_at)
+            try:
+                id_ = ObjectId(id_)
+            except InvalidId as e:
+                raise ValueError(str(e))
+            posts = posts.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=id_)
+            )
+        posts = posts.order_by("-created_at", "-id").limit(limit + 1)
+        if not full:
+            posts = posts.only(*cls.SUMMARY_FIELDS)
+        posts = list(posts)
+        next_cursor = posts[limit - 1].cursor if len(posts) > limit else None
+        return posts[:limit], next_cursor
+
+    @property
+    def author_ids(self):
+        # Works without dereferencing the authors, for no_dereference queries
+        return [author.id for author in self.authors]
 
     def can_edit(self, user):
-        return user.is_admin or (user.email in {a.id for a in self.authors})
+        return user.is_admin or (user.email in self.author_ids)
 
     def list_authors(self):
-        names = []
-        for author in self.authors:
-            names.append(author.nick_name)
+        author_ids = self.author_ids
+        authors = User.objects.in_bulk(author_ids)
+        names = [authors[id_].nick_name for id_ in author_ids if id_ in authors]
         names = ", ".join(names)
         return " & ".join(names.rsplit(",", 1))
 
@@ -226,6 +702,29 @@ class GDrivePhoto(db.Document):
     gdrive_path = db.StringField(required=True)
     gdrive_metadata = db.DictField()
     gdrive_created_at = db.DateTimeField(required=True)
+    synced_at = db.DateTimeField()
+    meta = {"indexes": ["gdrive_id", "gdrive_created_at"]}
+
+    @classmethod
+    def upsert(cls, photos, synced_at=None):
+        """Insert or update photos (dicts of field values), by gdrive_id."""
+        count, requests = 0, []
+        for photo in photos:
+            doc = cls(synced_at=synced_at, **photo).to_mongo()
+            doc.pop("_id", None)
+            requests.append(
+                UpdateOne({"gdrive_id": doc["gdrive_id"]}, {"$set": doc}, upsert=True)
+            )
+            if len(requests) == 1000:
+                count += cls._write(requests)
+                requests = []
+        return count + cls._write(requests)
+
+    @classmethod
+    def _write(cls, requests):
+        if requests:
+            cls._get_collection().bulk_write(requests, ordered=False)
+        return len(requests)
 
     @classmethod
     def new_photos(cls, n=2):
@@ -233,6 +732,192 @@ class GDrivePhoto(db.Document):
         return cls.objects.filter(gdrive_created_at__gte=days)
 
 
+class GDriveFolder(db.Document):
+    """Local mirror of the folder tree in the media drive."""
+
+    gdrive_id = db.StringField(primary_key=True)
+    name = db.StringField(required=True)
+    gdrive_parent = db.StringField(required=True)
+    gdrive_path = db.StringField(required=True)
+    synced_at = db.DateTimeField(required=True, default=datetime.datetime.now)
+    meta = {"indexes": ["gdrive_parent"]}
+
+    @classmethod
+    def sync(cls, folders, root, top_level_only=False):
+        """Upsert the folders, and delete the ones that no longer exist.
+
+        If ``top_level_only``, ``folders`` are only the direct children of the
+        ``root``, and the rest of the tree is left alone. The sync is recorded
+        even if there are no folders, so that an empty drive isn't listed again
+        until the mirror is stale.
+
+        """
+        synced_at = mongo_now()
+        for folder in folders:
+            cls.objects(gdrive_id=folder["gdrive_id"]).update_one(
+                upsert=True,
+                set__name=folder["name"],
+                set__gdrive_parent=folder["gdrive_parent"],
+                set__gdrive_path=folder["gdrive_path"],
+                set__synced_at=synced_at,
+            )
+        removed = cls.objects(synced_at__lt=synced_at)
+        if top_level_only:
+            removed = removed.filter(gdrive_parent=root)
+        removed.delete()
+        SyncState.set_value(cls.sync_state_name(root), synced_at.isoformat())
+
+    @staticmethod
+    def sync_state_name(root):
+        return "gdrive-folders:{}".format(root)
+
+    @classmethod
+    def last_synced(cls, root):
+        state = SyncState.objects(name=cls.sync_state_name(root)).first()
+        return state.updated_at if state else None
+
+
+class SyncState(db.Document):
+    """State, like sync tokens, kept between runs of the sync jobs."""
+
+    name = db.StringField(primary_key=True)
+    value = db.StringField()
+    updated_at = db.DateTimeField()
+
+    @classmethod
+    def get_value(cls, name):
+        state = cls.objects(name=name).first()
+        return state.value if state else None
+
+    @classmethod
+    def set_value(cls, name, value):
+        cls.objects(name=name).update_one(
+            upsert=True, set__value=value, set__updated_at=datetime.datetime.now()
+        )
+
+
+class CacheGeneration(db.Document):
+    """Counter that cached html is keyed by, bumped to invalidate the html."""
+
+    name = db.StringField(primary_key=True)
+    value = db.IntField(default=0)
+
+    @classmethod
+    def get_value(cls, name):
+        return cls.objects(name=name).scalar("value").first() or 0
+
+    @classmethod
+    def bump(cls, name):
+        cls.objects(name=name).update_one(upsert=True, inc__value=1)
+
+
+class CalendarEventState(db.Document):
+    """Calendar event last synced for an event or a birthday.
+
+    Keyed like the event's iCalUID prefix, ``rsvp:<event id>`` or
+    ``birthday:<email>``, so that syncs can skip events whose body hash hasn't
+    changed, without fetching them from the calendar.
+
+    """
+
+    key = db.StringField(primary_key=True)
+    kind = db.StringField(required=True, choices=("rsvp", "birthday"))
+    event_id = db.StringField(required=True)
+    body_hash = db.StringField()
+    date = db.DateTimeField()
+    synced_at = db.DateTimeField(default=datetime.datetime.now)
+    meta = {"indexes": [("kind", "date")]}
+
+    @property
+    def model_id(self):
+        return self.key.split(":", 1)[1]
+
+
+class CalendarChange(db.Document):
+    """Outbox of changes to events, to be synced to the calendar in order.
+
+    Changes only record which event changed. The sync uses the event's state
+    at that time, so retrying, or syncing several changes at once, is safe.
+
+    """
+
+    event_id = db.ObjectIdField(required=True)
+    action = db.StringField(required=True, choices=("save", "delete", "archive"))
+    created_at = db.DateTimeField(required=True, default=datetime.datetime.now)
+    attempts = db.IntField(default=0)
+    next_attempt_at = db.DateTimeField(default=datetime.datetime.now)
+    error = db.StringField()
+    meta = {"indexes": [("next_attempt_at", "created_at")]}
+
+    @classmethod
+    def add(cls, event_ids, action):
+        now = datetime.datetime.now()
+        changes = [
+            cls(event_id=id_, action=action, created_at=now, next_attempt_at=now)
+            for id_ in event_ids
+        ]
+        if changes:
+            cls.objects.insert(changes, load_bulk=False)
+
+    @classmethod
+    def pending(cls, limit):
+        now = datetime.datetime.now()
+        due = cls.objects(next_attempt_at__lte=now).order_by("created_at", "id")
+        return due[:limit]
+
+
+class WaitlistPromotion(db.Document):
+    """Outbox of RSVPs that got a spot off an event's waitlist, to be notified.
+
+    Keyed by the RSVP, so that an RSVP promoted more than once before the
+    notifications go out is notified once. Notifiers claim the promotions they
+    send, and the claims of notifiers that died are taken over later.
+
+    """
+
+    id = db.ObjectIdField(primary_key=True)
+    event_id = db.ObjectIdField(required=True)
+    created_at = db.DateTimeField(required=True, default=datetime.datetime.now)
+    claimed_by = db.StringField()
+    claimed_at = db.DateTimeField()
+    meta = {"indexes": ["claimed_by", "claimed_at"]}
+
+    @classmethod
+    def add(cls, event_id, rsvp_ids):
+        now = datetime.datetime.now()
+        requests = [
+            UpdateOne(
+                {"_id": id_},
+                {"$setOnInsert": {"event_id": event_id, "created_at": now}},
+                upsert=True,
+            )
+            for id_ in rsvp_ids
+        ]
+        if requests:
+            cls._get_collection().bulk_write(requests, ordered=False)
+
+    @classmethod
+    def claim(cls, claimed_by, timeout):
+        """Claim the promotions not claimed by a live notifier, and return them."""
+        now = datetime.datetime.now()
+        unclaimed = Q(claimed_at=None) | Q(claimed_at__lt=now - timeout)
+        cls.objects(unclaimed).update(set__claimed_by=claimed_by, set__claimed_at=now)
+        return cls.objects(claimed_by=claimed_by)
+
+
+class OutboxEmail(db.Document):
+    """Email queued to be sent by the mailer."""
+
+    to = db.StringField(required=True)
+    subject = db.StringField(required=True)
+    body = db.StringField(required=True)
+    created_at = db.DateTimeField(required=True, default=datetime.datetime.now)
+    attempts = db.IntField(default=0)
+    next_attempt_at = db.DateTimeField(default=datetime.datetime.now)
+    error = db.StringField()
+    meta = {"indexes": [("next_attempt_at", "created_at")]}
+
+
 class InterestedUser(db.Document):
     created_at = db.DateTimeField(required=True, default=datetime.datetime.now)
     email = db.EmailField()
@@ -0,0 +1,114 @@
+"""Notifications to users, like getting a spot off an event's waitlist.
+
+Waitlist updates record the promotions in an outbox collection. A background
+thread in the web server sends them a few seconds later, batched by event, so
+that requests never wait on them, and users promoted more than once in that
+time are notified once. A cron job sends the ones recorded by scripts, and the
+ones left behind by workers that died.
+
+"""
+
+import datetime
+import threading
+import time
+
+from flask import current_app
+
+from .mailer import queue_emails
+from .models import ANONYMOUS_EMAIL, Event, User, WaitlistPromotion, waitlist_promoted
+from .utils import event_absolute_url, random_string
+
+# Seconds for which promotions are collected before being sent together
+BATCH_DELAY = 5
+# Promotions claimed by a notifier that died before sending them are sent after
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+
+
+def email_promoted_users(event, rsvps):
+    users = User.objects.in_bulk([rsvp.user.id for rsvp in rsvps])
+    users = [user for user in users.values() if user.email != ANONYMOUS_EMAIL]
+    template = current_app.jinja_env.get_template("waitlist_promoted.txt")
+    subject = "You have a spot at {}".format(event.name)
+    url = event_absolute_url(event)
+    queue_emails(
+        (user, subject, template.render(user=user, event=event, url=url))
+        for user in users
+    )
+
+
+class NotificationDispatcher:
+    """Sends the recorded waitlist promotions through each of the channels.
+
+    The thread is started by the web server processes, and woken up when a
+    promotion is made in the process.
+
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        # Web push, etc. can be added here
+        self.channels = [email_promoted_users]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("NOTIFICATIONS_WORKER", False)
+        waitlist_promoted.connect(self.on_promoted)
+
+    def start(self):
+        """Start the thread, which first sends the promotions already pending."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def on_promoted(self, event, rsvps):
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    print("Error sending notifications: {}".format(e))
+            self._wakeup.wait()
+            # Collect the other promotions made around the same time
+            self._wakeup.clear()
+            time.sleep(BATCH_DELAY)
+
+    def flush(self):
+        """Send the pending notifications, one batch per event.
+
+        Returns the number of RSVPs notified.
+
+        """
+        promotions = list(WaitlistPromotion.claim(random_string(), CLAIM_TIMEOUT))
+        pending = {}
+        for promotion in promotions:
+            pending.setdefault(promotion.event_id, set()).add(promotion.id)
+        events = Event.objects.in_bulk(list(pending))
+        notified = 0
+        for event_id, rsvp_ids in pending.items():
+            event = events.get(event_id)
+            if event is None:
+                continue
+            # RSVPs may have been cancelled, or waitlisted again, since
+            rsvps = [rsvp for rsvp in event.active_rsvps if rsvp.id in rsvp_ids]
+            if not rsvps:
+                continue
+            for channel in self.channels:
+                channel(event, rsvps)
+            notified += len(rsvps)
+        WaitlistPromotion.objects(id__in=[p.id for p in promotions]).delete()
+        return notified
+
+
+notification_dispatcher = NotificationDispatcher()
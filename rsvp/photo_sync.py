@@ -0,0 +1,86 @@
+"""Sync the photos in the media drive into the DB.
+
+The first sync crawls the whole drive. Later syncs only fetch the changes made
+since the previous sync, using the Drive Changes API, and fall back to a full
+crawl when the folder tree itself has changed.
+
+"""
+from .gdrive_utils import (
+    FOLDER_MIME_TYPE,
+    folders_with_photos,
+    get_start_page_token,
+    list_changes,
+    photo_info,
+)
+from .models import GDriveFolder, GDrivePhoto, SyncState
+from .utils import mongo_now
+
+PAGE_TOKEN = "gdrive-photos-page-token"
+
+
+def sync_photos(service, root, full=False):
+    """Sync the photos, incrementally unless a full rescan is asked for."""
+    page_token = SyncState.get_value(PAGE_TOKEN)
+    if full or page_token is None:
+        return full_sync(service, root)
+
+    changes, new_page_token = list_changes(service, page_token)
+    if not apply_changes(changes, root):
+        print("Folders have changed, doing a full rescan")
+        return full_sync(service, root)
+    SyncState.set_value(PAGE_TOKEN, new_page_token)
+
+
+def full_sync(service, root):
+    """Crawl the whole drive, and replace the photos and folders in the DB."""
+    # Changes made while crawling are picked up by the next incremental sync
+    page_token = get_start_page_token(service)
+    synced_at = mongo_now()
+    folders = []
+
+    def crawl():
+        for folder, photos in folders_with_photos(service, root):
+            folders.append(folder)
+            yield from photos
+
+    count = GDrivePhoto.upsert(crawl(), synced_at=synced_at)
+    if count == 0:
+        # Don't wipe out the photos, if the drive couldn't be read
+        print("No photos found in the drive")
+        return
+    removed = GDrivePhoto.objects(synced_at__ne=synced_at).delete()
+    GDriveFolder.sync(folders, root)
+    SyncState.set_value(PAGE_TOKEN, page_token)
+    print("Synced {} photos, removed {}".format(count, removed))
+
+
+def apply_changes(changes, root):
+    """Apply changes to photos. Return False if any folder has changed."""
+    folders = {folder.gdrive_id: folder for folder in GDriveFolder.objects}
+    updated, removed = [], set()
+    for change in changes:
+        file_id = change["fileId"]
+        file = change.get("file", {})
+        parents = file.get("parents", [])
+        if file_id in folders or file.get("mimeType") == FOLDER_MIME_TYPE:
+            if file_id in folders or root in parents or set(parents) & set(folders):
+                return False
+            # Folders outside the media drive are of no interest
+            continue
+
+        if change.get("removed") or file.get("trashed"):
+            removed.add(file_id)
+            continue
+        if not file.get("mimeType", "").startswith("image/"):
+            continue
+        parent = next((folders[id_] for id_ in parents if id_ in folders), None)
+        if parent is None:
+            # Photos not in the media drive (or moved out of it)
+            removed.add(file_id)
+        else:
+            updated.append(photo_info(file, parent.gdrive_id, parent.gdrive_path))
+
+    count = GDrivePhoto.upsert(updated, synced_at=mongo_now())
+    deleted = GDrivePhoto.objects(gdrive_id__in=list(removed)).delete()
+    print("Updated {} photos, removed {}".format(count, deleted))
+    return True
@@ -4,10 +4,11 @@ import codecs
 import random
 from datetime import datetime
 
-from flask import render_template
+from flask import current_app
 
+from rsvp.mailer import queue_emails
 from rsvp.models import Event, User
-from rsvp.utils import send_email, upload_file
+from rsvp.utils import upload_file
 
 YEAR = datetime.now().year
 SENDER = "Fun Committee, TIKS"
@@ -21,46 +22,108 @@ Subject: {subject}\r
 
 
 def get_people(event_id):
-    """Reads list of participants from ../data/secret-santa.csv
+    """Return the users with active RSVPs to the event."""
+    event = Event.objects.get(id=event_id)
+    ids = [rsvp.user.id for rsvp in event.active_rsvps]
+    users = User.objects.in_bulk(ids)
+    return [users[id_] for id_ in ids if id_ in users]
 
-    The CSV file needs to have column headers and a column named 'Email'. The
-    first column MUST be the names of the participants.
 
-    """
-    event = Event.objects.get(id=event_id)
-    return [rsvp.user.fetch() for rsvp in event.active_rsvps]
+def couples_exclusions(couples):
+    """Exclusions for couples, who shouldn't be each other's santas."""
+    return {pair for a, b in couples for pair in ((a, b), (b, a))}
 
 
-def is_good_pairing(pairs):
+def is_good_pairing(pairs, people, exclusions=()):
     """Function to test if a pairing is valid."""
-    santas = set()
-    kiddos = set()
+    emails = {person.email for person in people}
+    santas = {santa for santa, _ in pairs}
+    kiddos = {kiddo for _, kiddo in pairs}
+    excluded = set(exclusions)
+    return (
+        len(pairs) == len(emails)
+        and santas == kiddos == emails
+        and all(santa != kiddo for santa, kiddo in pairs)
+        and not any(pair in excluded for pair in pairs)
+    )
 
-    for santa, kiddo in pairs:
-        if santa == kiddo:
-            return False
-        santas.add(santa)
-        kiddos.add(kiddo)
 
-    return len(santas) == len(kiddos) == len(list(pairs))
+def pick_pairs(people, exclusions=(), rng=random):
+    """Pick a santa for each person, avoiding the excluded (santa, kiddo) pairs.
 
+    A random derangement is picked using Sattolo's algorithm, in O(n). Santas
+    whose kiddo is excluded are then re-paired using augmenting paths (Kuhn's
+    algorithm), which is bounded even with heavy constraints. ValueError is
+    raised if no pairing is possible. Pass a seeded ``random.Random`` as
+    ``rng`` to get the same pairs again.
 
-def pick_pairs(people):
-    """Pick pairs from a list of users."""
-    n = len(people)
-    m = n // 2
+    """
     names = [person.email for person in people]
-    # Shuffle the names
-    santas = random.sample(names, n)
-    # Split the shuffled names into two halves and assign kiddos from 'other'
-    # halves.  Shuffle the santa names, before assignment.
-    m_ = n - m
-    santas_1, santas_2 = (
-        random.sample(santas[:m], m),
-        random.sample(santas[m:], m_),
-    )
-    kiddos_1, kiddos_2 = santas[m_:], santas[:m_]
-    return list(zip(santas_1, kiddos_1)) + list(zip(santas_2, kiddos_2))
+    n = len(names)
+    if n < 2:
+        raise ValueError("Need at least 2 people to pick pairs")
+    excluded = set(exclusions)
+
+    # Sattolo's algorithm gives a random single cycle, so nobody is their own
+    # kiddo
+    kiddos = names[:]
+    for i in range(n - 1, 0, -1):
+        j = rng.randrange(i)
+        kiddos[i], kiddos[j] = kiddos[j], kiddos[i]
+
+    kiddo_of, santa_of, unpaired = {}, {}, []
+    for santa, kiddo in zip(names, kiddos):
+        if (santa, kiddo) in excluded:
+            unpaired.append(santa)
+        else:
+            kiddo_of[santa] = kiddo
+            santa_of[kiddo] = santa
+
+    candidates = {}
+
+    def allowed_kiddos(santa):
+        if santa not in candidates:
+            allowed = [
+                kiddo
+                for kiddo in names
+                if kiddo != santa and (santa, kiddo) not in excluded
+            ]
+            rng.shuffle(allowed)
+            candidates[santa] = allowed
+        return candidates[santa]
+
+    for santa in unpaired:
+        if not _augment(santa, allowed_kiddos, kiddo_of, santa_of):
+            raise ValueError("No pairing possible with the given exclusions")
+    return [(santa, kiddo_of[santa]) for santa in names]
+
+
+def _augment(start, allowed_kiddos, kiddo_of, santa_of):
+    """Find a kiddo for start, re-pairing other santas along the way."""
+    reached_from = {}
+    stack = [(start, iter(allowed_kiddos(start)))]
+    while stack:
+        santa, kiddos = stack[-1]
+        for kiddo in kiddos:
+            if kiddo in reached_from:
+                continue
+            reached_from[kiddo] = santa
+            if kiddo not in santa_of:
+                # Shift every santa on the path to the kiddo it reached
+                while True:
+                    santa = reached_from[kiddo]
+                    previous = kiddo_of.get(santa)
+                    kiddo_of[santa] = kiddo
+                    santa_of[kiddo] = santa
+                    if santa == start:
+                        return True
+                    kiddo = previous
+            other = santa_of[kiddo]
+            stack.append((other, iter(allowed_kiddos(other))))
+            break
+        else:
+            stack.pop()
+    return False
 
 
 def persist_pairs(pairs, test=False):
@@ -76,28 +139,31 @@ def persist_pairs(pairs, test=False):
     upload_file(f.name)
 
 
-def notify_santas(pairs, test=True):
+def notify_santas(pairs, test=True, users=None):
+    if users is None:
+        users = User.objects.in_bulk([email for pair in pairs for email in pair])
+    # Render the template directly, skipping the app's per-request context
+    template = current_app.jinja_env.get_template("secret-santa.txt")
+    messages = []
     for santa, kiddo in pairs:
-        santa = User.objects.get(email=santa)
-        kiddo = User.objects.get(email=kiddo)
-        content = render_template(
-            "secret-santa.txt",
+        santa = users[santa]
+        kiddo = users[kiddo]
+        content = template.render(
             santa_name=(santa.nick_name),
             kiddo_name=(kiddo.nick_name),
             kiddo=kiddo,
             from_=SENDER,
         )
         if not test:
-            send_email([santa], SUBJECT, content)
+            messages.append((santa, SUBJECT, content))
         else:
             print(content)
+    queue_emails(messages)
 
 
-def main(people, test=True):
-    good_pairs = False
-    while not good_pairs:
-        pairs = pick_pairs(people)
-        good_pairs = is_good_pairing(pairs)
+def main(people, test=True, exclusions=(), seed=None):
+    pairs = pick_pairs(people, exclusions, random.Random(seed))
     persist_pairs(pairs, test=test)
-    notify_santas(pairs, test=test)
+    users = {person.email: person for person in people}
+    notify_santas(pairs, test=test, users=users)
     return pairs
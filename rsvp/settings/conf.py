@@ -13,6 +13,11 @@ LOGO = os.environ.get(
 )
 COMPANY = os.environ.get("COMPANY", "CloudYuga Technology Pvt. Ltd.")
 DEBUG = "DEBUG" in os.environ
+# Requests to old hosts of the app are redirected to the canonical host
+CANONICAL_HOST = os.environ.get("CANONICAL_HOST", "rsvp.tiks-ultimate.in")
+LEGACY_HOSTS = os.environ.get(
+    "LEGACY_HOSTS", "thatte-idli-rsvp.herokuapp.com,tiks-ultimate-rsvp.fly.dev"
+).split(",")
 SOCIAL = [
     {
         "name": "Instagram",
@@ -48,6 +53,37 @@ SOCIAL = [
         "type": "page",
     },
 ]
+# Number of posts shown per page on /posts and /api/posts/
+POSTS_PER_PAGE = 20
+# Cache for rendered html fragments: "simple" (in-memory), "filesystem" or "null"
+FRAGMENT_CACHE_TYPE = os.environ.get("FRAGMENT_CACHE_TYPE", "simple")
+FRAGMENT_CACHE_DIR = os.environ.get("FRAGMENT_CACHE_DIR", "/tmp/rsvp-fragments")
+FRAGMENT_CACHE_TIMEOUT = 24 * 60 * 60
+FRAGMENT_CACHE_THRESHOLD = 1000
+# Cache for public pages viewed by logged out visitors
+PAGE_CACHE_TYPE = os.environ.get("PAGE_CACHE_TYPE", "simple")
+PAGE_CACHE_DIR = os.environ.get("PAGE_CACHE_DIR", "/tmp/rsvp-pages")
+PAGE_CACHE_TIMEOUT = 24 * 60 * 60
+PAGE_CACHE_THRESHOLD = 200
+# How long browsers and proxies may reuse a cached page without revalidating
+PAGE_CACHE_MAX_AGE = 300
+# Seconds after which the mirrored GDrive folders are refreshed by /media
+GDRIVE_FOLDERS_MAX_AGE = 90 * 60
+# Compute the social account passwords in a thread when the app starts
+PRECOMPUTE_SOCIAL_PASSWORDS = True
+# SMTP server for emails, which are queued and sent by a background worker
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.zeptomail.in")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "1") == "1"
+SMTP_USER = os.environ.get("ZEPTOMAIL_USER")
+SMTP_PASSWORD = os.environ.get("ZEPTOMAIL_PASSWORD")
+FROM_EMAIL = os.environ.get("FROM_EMAIL", "noreply@tiks-ultimate.in")
+# Connections used at once to send queued emails, within the server's limits
+SMTP_MAX_CONNECTIONS = int(os.environ.get("SMTP_MAX_CONNECTIONS", "3"))
+# Send the queued emails from a thread in the web app
+EMAIL_WORKER = True
+# Send notifications, like waitlist promotions, from a thread in the web app
+NOTIFICATIONS_WORKER = True
 # Calendar settings
 EVENT_DURATION = 7200  # 2 hours
 TIMEZONE = "Asia/Kolkata"
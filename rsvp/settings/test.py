@@ -6,3 +6,6 @@ from conf import *
 
 MONGODB_SETTINGS = {'host': 'mongomock://localhost:27017/rsvpdata'}
 LOGIN_DISABLED = True
+PRECOMPUTE_SOCIAL_PASSWORDS = False
+EMAIL_WORKER = False
+NOTIFICATIONS_WORKER = False
@@ -1,10 +1,5 @@
 var rsvp_count = function(event) {
-    if (!event.rsvps) {
-        return 0;
-    }
-    return event.rsvps.filter(rsvp => {
-        return !rsvp.cancelled && !rsvp.waitlisted;
-    }).length;
+    return event.rsvp_count || 0;
 };
 $(function() {
     var calendarEl = document.getElementById('calendar');
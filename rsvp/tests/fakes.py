@@ -0,0 +1,288 @@
+"""In-memory stand-ins for the Google API clients, to run tests offline."""
+
+import datetime
+import itertools
+import json
+import re
+
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+
+FOLDER = "application/vnd.google-apps.folder"
+
+
+class FakeRequest:
+    def __init__(self, method, kwargs):
+        self.method = method
+        self.kwargs = kwargs
+
+    def execute(self, **kwargs):
+        return self.method(**self.kwargs)
+
+
+def rate_limit_error():
+    content = {
+        "error": {
+            "code": 403,
+            "message": "Rate limit exceeded",
+            "errors": [{"reason": "rateLimitExceeded"}],
+        }
+    }
+    return HttpError(Response({"status": 403}), json.dumps(content).encode())
+
+
+class FakeBatch:
+    """Batch of requests, like ``service.new_batch_http_request()``."""
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.batches.append(len(self.requests))
+        for request_id, request in self.requests:
+            try:
+                response = request.execute()
+            except HttpError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
+class FakeResource:
+    """A collection resource, like ``service.files()``."""
+
+    def __init__(self, **methods):
+        self._methods = methods
+
+    def __getattr__(self, name):
+        try:
+            method = self._methods[name]
+        except KeyError:
+            raise AttributeError(name)
+        return lambda **kwargs: FakeRequest(method, kwargs)
+
+
+def paginate(items, key, page_size, page_token):
+    start = int(page_token or 0)
+    page = {key: items[start : start + page_size]}
+    if start + page_size < len(items):
+        page["nextPageToken"] = str(start + page_size)
+    return page
+
+
+class FakeService:
+    def __init__(self, page_size=100):
+        self.page_size = page_size
+        self._ids = itertools.count()
+        self.requests = []
+        self.batches = []
+        # Number of the next requests to be rejected as rate limited
+        self.rate_limited = 0
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def _check_rate_limit(self):
+        if self.rate_limited > 0:
+            self.rate_limited -= 1
+            raise rate_limit_error()
+
+
+class FakeDrive(FakeService):
+    """Fake Drive service, with the files kept in a dict."""
+
+    def __init__(self, page_size=100):
+        super().__init__(page_size)
+        self.files_ = {}
+        self.changes_ = []
+        self.permissions_ = {}
+
+    def _changed(self, id_):
+        file = self.files_.get(id_)
+        change = {"fileId": id_, "removed": file is None}
+        if file is not None:
+            change["file"] = dict(file)
+        self.changes_.append(change)
+
+    def add_folder(self, id_, name, parent):
+        self.files_[id_] = {
+            "id": id_,
+            "name": name,
+            "mimeType": FOLDER,
+            "parents": [parent],
+        }
+        self._changed(id_)
+
+    def add_photo(self, id_, parent, created_time="2020-01-01T10:00:00.000Z"):
+        self.files_[id_] = {
+            "id": id_,
+            "name": "{}.jpg".format(id_),
+            "mimeType": "image/jpeg",
+            "parents": [parent],
+            "thumbnailLink": "https://example.com/{}.jpg".format(id_),
+            "imageMediaMetadata": {},
+            "createdTime": created_time,
+        }
+        self._changed(id_)
+
+    def update(self, id_, **fields):
+        self.files_[id_].update(fields)
+        self._changed(id_)
+
+    def remove(self, id_):
+        del self.files_[id_]
+        self._changed(id_)
+
+    def add_permission(self, email, role="writer"):
+        id_ = "permission-{}".format(next(self._ids))
+        self.permissions_[id_] = {"id": id_, "emailAddress": email, "role": role}
+
+    def permissions(self):
+        return FakeResource(
+            list=self._list_permissions,
+            create=self._create_permission,
+            delete=self._delete_permission,
+        )
+
+    def _list_permissions(self, fileId, pageSize=None, pageToken=None, **kwargs):
+        permissions = list(self.permissions_.values())
+        page_size = min(pageSize or self.page_size, self.page_size)
+        return paginate(permissions, "permissions", page_size, pageToken)
+
+    def _create_permission(self, fileId, body, **kwargs):
+        self._check_rate_limit()
+        self.add_permission(body["emailAddress"], body["role"])
+
+    def _delete_permission(self, fileId, permissionId):
+        self._check_rate_limit()
+        del self.permissions_[permissionId]
+
+    def files(self):
+        return FakeResource(list=self._list_files)
+
+    def changes(self):
+        return FakeResource(
+            getStartPageToken=self._get_start_page_token, list=self._list_changes
+        )
+
+    def _get_start_page_token(self, **kwargs):
+        return {"startPageToken": str(len(self.changes_))}
+
+    def _list_changes(self, pageToken, pageSize=None, **kwargs):
+        self.requests.append(("changes.list", pageToken))
+        start = int(pageToken)
+        page_size = min(pageSize or self.page_size, self.page_size)
+        page = {"changes": self.changes_[start : start + page_size]}
+        if start + page_size < len(self.changes_):
+            page["nextPageToken"] = str(start + page_size)
+        else:
+            page["newStartPageToken"] = str(len(self.changes_))
+        return page
+
+    def _list_files(self, q, fields=None, pageSize=None, pageToken=None, **kwargs):
+        self.requests.append(("files.list", q, pageToken))
+        parent = re.search("'([^']+)' in parents", q).group(1)
+        files = [f for f in self.files_.values() if parent in f["parents"]]
+        if "trashed = false" in q:
+            files = [f for f in files if not f.get("trashed")]
+        if "mimeType='{}'".format(FOLDER) in q:
+            files = [f for f in files if f["mimeType"] == FOLDER]
+        elif "mimeType contains 'image/'" in q:
+            files = [f for f in files if f["mimeType"].startswith("image/")]
+        page_size = min(pageSize or self.page_size, self.page_size)
+        return paginate(files, "files", page_size, pageToken)
+
+
+class FakeCalendar(FakeService):
+    """Fake Calendar service, with a single calendar of events."""
+
+    def __init__(self, page_size=100):
+        super().__init__(page_size)
+        self.events_ = {}
+        # Sequence number of the last change to each event, for sync tokens
+        self.changed_ = {}
+        self._seq = itertools.count(1)
+
+    def events(self):
+        return FakeResource(
+            list=self._list_events,
+            insert=self._insert_event,
+            update=self._update_event,
+            delete=self._delete_event,
+        )
+
+    def _list_events(
+        self,
+        calendarId,
+        pageToken=None,
+        maxResults=None,
+        syncToken=None,
+        timeMin=None,
+        timeMax=None,
+        **kwargs,
+    ):
+        self.requests.append(("events.list", pageToken))
+        if syncToken is not None:
+            # Deleted events are listed as cancelled
+            events = [
+                self.events_.get(id_, {"id": id_, "status": "cancelled"})
+                for id_, seq in self.changed_.items()
+                if seq > int(syncToken)
+            ]
+        else:
+            events = list(self.events_.values())
+        if timeMin is not None:
+            events = [e for e in events if e["end"].get("dateTime", "9999") >= timeMin]
+        if timeMax is not None:
+            events = [e for e in events if e["start"].get("dateTime", "") < timeMax]
+        page_size = min(maxResults or self.page_size, self.page_size)
+        page = paginate(events, "items", page_size, pageToken)
+        if "nextPageToken" not in page:
+            page["nextSyncToken"] = str(max(self.changed_.values(), default=0))
+        return page
+
+    def _store(self, id_, body):
+        event = dict(body, id=id_)
+        for key in ("start", "end"):
+            # Times are returned in UTC, like the real calendar does
+            if "dateTime" in body[key]:
+                date_time = datetime.datetime.fromisoformat(body[key]["dateTime"])
+                event[key] = {"dateTime": date_time.strftime("%Y-%m-%dT%H:%M:%SZ")}
+        self.events_[id_] = event
+        self.changed_[id_] = next(self._seq)
+        return event
+
+    def _insert_event(self, calendarId, body):
+        self._check_rate_limit()
+        self.requests.append(("events.insert", body["iCalUID"]))
+        return self._store("event-{}".format(next(self._ids)), body)
+
+    def _update_event(self, calendarId, eventId, body):
+        self._check_rate_limit()
+        self.requests.append(("events.update", eventId))
+        iCalUID = self.events_[eventId]["iCalUID"]
+        return self._store(eventId, dict(body, iCalUID=iCalUID))
+
+    def _delete_event(self, calendarId, eventId):
+        self._check_rate_limit()
+        self.requests.append(("events.delete", eventId))
+        del self.events_[eventId]
+        self.changed_[eventId] = next(self._seq)
+
+
+class SMTPRecorder:
+    """aiosmtpd handler that records the messages it receives."""
+
+    def __init__(self):
+        self.messages = []
+        self.peers = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.peers.add(session.peer)
+        self.messages.append((envelope.rcpt_tos, envelope.content.decode()))
+        return "250 Message accepted for delivery"
@@ -1,8 +1,25 @@
 import datetime
 import json
-from unittest.mock import patch
+import os
+import random
+import smtplib
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
 
-from rsvp import app, models, views  # noqa
+import pytest
+from cachelib import SimpleCache
+from flask import render_template
+from mongoengine.errors import NotUniqueError
+from mongoengine.queryset.base import BaseQuerySet
+
+from rsvp import app, calendar_sync, gdrive_utils, models, photo_sync, views  # noqa
+from rsvp.cache import fragment_cache
+from rsvp.gdrive_utils import create_oauth_service
+from rsvp.mailer import MailWorker, SMTPConnection, send_pending
+from rsvp.tests.fakes import FakeCalendar, FakeDrive, SMTPRecorder
+from rsvp.utils import get_attendance, read_app_config, send_email
 
 
 class BaseTest:
@@ -29,6 +46,289 @@ class TestRSVPApp(BaseTest):
             )
         assert response.status_code == 200
 
+    def test_versioned_static_files(self):
+        path = os.path.join(app.static_folder, "test-versioned.css")
+        variants = {"": b"body {}", ".gz": b"gzipped", ".br": b"brotlied"}
+        for extension, data in variants.items():
+            with open(path + extension, "wb") as f:
+                f.write(data)
+        url = "/version-abc/static/test-versioned.css"
+        try:
+            for accept_encoding, encoding, body in (
+                ("gzip, deflate, br", "br", b"brotlied"),
+                ("gzip", "gzip", b"gzipped"),
+                ("identity", None, b"body {}"),
+            ):
+                headers = {"Accept-Encoding": accept_encoding}
+                response = self.client.get(url, headers=headers)
+                assert response.status_code == 200
+                assert response.content_encoding == encoding
+                assert response.get_data() == body
+                assert response.mimetype == "text/css"
+                assert "Accept-Encoding" in response.vary
+                cache_control = response.cache_control
+                assert cache_control.public and cache_control.immutable
+                assert cache_control.max_age == 365 * 24 * 60 * 60
+                response.close()
+        finally:
+            for extension in variants:
+                os.remove(path + extension)
+        assert self.client.get(url).status_code == 404
+
+    def test_read_app_config(self):
+        # The test settings find the settings they extend from their __file__
+        config = read_app_config()
+        assert config["__file__"].endswith(os.path.join("settings", "test.py"))
+        assert config["LOGIN_DISABLED"] is True
+        assert config["EVENT_DURATION"] == app.config["EVENT_DURATION"]
+
+    def test_legacy_host_redirect(self):
+        response = self.client.get(
+            "/api/posts/?limit=1",
+            headers={"Host": "thatte-idli-rsvp.herokuapp.com"},
+        )
+        assert response.status_code == 301
+        assert response.location == "http://rsvp.tiks-ultimate.in/api/posts/?limit=1"
+        assert self.client.get("/api/posts/?limit=1").status_code == 200
+
+    def test_upcoming_event_summaries(self):
+        with app.test_request_context():
+            late = models.Event(name="Late", date=datetime.datetime(2018, 2, 1))
+            early = models.Event(name="Early", date=datetime.datetime(2018, 1, 1))
+            late.save()
+            early.save()
+            models.Event(name="Old", date="2017-01-01", archived=True).save()
+            summaries = models.EventSummary.upcoming()
+            assert [s.name for s in summaries] == ["Early", "Late"]
+            assert summaries[0].url == "/event/{}".format(early.id)
+            assert (summaries[0].weekday, summaries[0].day) == ("Mon", "01 Jan")
+            assert [s.rsvp_count for s in summaries] == [0, 0]
+            assert models.EventSummary.upcoming() is summaries
+            with pytest.raises(AttributeError):
+                summaries[0].name = "Changed"
+
+            late.add_rsvp(models.RSVP(user=self.user))
+            summaries = models.EventSummary.upcoming()
+            assert [s.rsvp_count for s in summaries] == [0, 1]
+            early.cancelled = True
+            early.save()
+            assert models.EventSummary.upcoming()[0].cancelled
+
+    def test_archive_ended_events(self):
+        now = datetime.datetime(2018, 1, 10, 12)
+        with app.test_request_context():
+            ended = models.Event(name="Ended", date=datetime.datetime(2018, 1, 10, 9))
+            running = models.Event(name="On", date=datetime.datetime(2018, 1, 10, 11))
+            long_running = models.Event(
+                name="Long",
+                date=datetime.datetime(2018, 1, 9),
+                _end_date=datetime.datetime(2018, 1, 11),
+            )
+            postponed = models.Event(
+                name="Postponed",
+                date=datetime.datetime(2018, 1, 20),
+                _end_date=datetime.datetime(2018, 1, 20, 2),
+                archived=True,
+            )
+            # Archived by hand, and left archived
+            hidden = models.Event(
+                name="Hidden", date=datetime.datetime(2018, 1, 20), archived=True
+            )
+            for event in (ended, running, long_running, postponed, hidden):
+                event.save()
+
+            changed = models.Event.archive_ended(now)
+            assert sorted(changed) == sorted([ended.id, postponed.id])
+            archived = models.Event.objects(archived=True).scalar("name")
+            assert sorted(archived) == ["Ended", "Hidden"]
+            assert ended.reload().version == 2
+            assert running.reload().version == 1
+            # Nothing is written when nothing has changed
+            assert models.Event.archive_ended(now) == []
+
+    def test_delete_cancelled_events_without_rsvps(self):
+        with app.test_request_context():
+            empty = models.Event(name="Empty", date="2018-01-01", cancelled=True)
+            cancelled_rsvps = models.Event(name="No", date="2018-01-01", cancelled=True)
+            attended = models.Event(name="Yes", date="2018-01-01", cancelled=True)
+            upcoming = models.Event(name="Upcoming", date="2018-01-01")
+            for event in (empty, cancelled_rsvps, attended, upcoming):
+                event.save()
+            cancelled_rsvps.add_rsvp(models.RSVP(user=self.user, cancelled=True))
+            attended.add_rsvp(models.RSVP(user=self.user))
+            models.CalendarChange.objects.delete()
+
+            events = models.Event.cancelled_without_rsvps()
+            assert sorted(name for _, name in events) == ["Empty", "No"]
+            models.Event.bulk_delete([id_ for id_, _ in events])
+            assert sorted(models.Event.objects.scalar("name")) == ["Upcoming", "Yes"]
+            assert models.RSVP.objects.count() == 1
+            changes = set(models.CalendarChange.objects.scalar("event_id", "action"))
+            assert changes == {(empty.id, "delete"), (cancelled_rsvps.id, "delete")}
+
+    def test_rsvp_partition(self):
+        with app.test_request_context():
+            event = models.Event(name="Hat", date="2018-01-01", rsvp_limit=2)
+            event.save()
+            for i in range(4):
+                user = models.User(
+                    email="{}@example.com".format(i), name=str(i), gender="female"
+                ).save()
+                date = datetime.datetime(2018, 1, 1, 10, 3 - i)
+                event.add_rsvp(models.RSVP(user=user, date=date))
+            event.update_rsvp(event.rsvps.get(user="3@example.com"), cancelled=True)
+            event.update_waitlist()
+
+            rsvps = event.rsvp_partition
+            active = [r.user.id for r in rsvps.active]
+            assert active == ["2@example.com", "1@example.com"]
+            assert [r.user.id for r in rsvps.waitlisted] == ["0@example.com"]
+            assert [r.user.id for r in rsvps.all][-1] == "3@example.com"
+            assert event.rsvp_count == 2
+            assert len(event.female_rsvps) == 2
+            assert event.active_rsvps is rsvps.active
+            markdown = render_template("full-names.md", rsvps=rsvps, TEXT2="Hat")
+            assert "1. 2" in markdown and "2. 1" in markdown
+
+            event.update_rsvp(rsvps.active[0], cancelled=True)
+            event.update_waitlist()
+            assert event.rsvp_partition is not rsvps
+            assert len(event.rsvp_partition.active) == 2
+            assert event.rsvp_partition.waitlisted == []
+
+    def test_one_rsvp_per_user(self):
+        with app.test_request_context():
+            models.RSVP.ensure_indexes()
+            event = models.Event(name="Once", date="2018-01-01")
+            event.save()
+            rsvp = models.RSVP(event=event, user=self.user).save()
+            with pytest.raises(NotUniqueError):
+                models.RSVP(event=event, user=self.user).save()
+            # The anonymous user can RSVP many times
+            anonymous = models.User(email=models.ANONYMOUS_EMAIL, name="Anonymous")
+            anonymous.save()
+            event.add_rsvp(models.RSVP(user=anonymous))
+            event.add_rsvp(models.RSVP(user=anonymous))
+            assert event.rsvps.count() == 3
+
+            # A concurrent upsert that lost the race gets the existing RSVP
+            with patch.object(BaseQuerySet, "modify", side_effect=NotUniqueError):
+                existing = event.add_rsvp(models.RSVP(user=self.user))
+            assert existing.id == rsvp.id
+            assert event.rsvps.count() == 3
+
+    def test_move_rsvps_to_user(self):
+        with app.test_request_context():
+            models.RSVP.ensure_indexes()
+            other = models.User(email="bar@example.com", name="Other").save()
+            both, only_other = [
+                models.Event(name=name, date="2018-01-01").save()
+                for name in ("Both", "Other")
+            ]
+            kept = models.RSVP(user=other, date=datetime.datetime(2018, 1, 1, 9))
+            both.add_rsvp(kept)
+            both.add_rsvp(
+                models.RSVP(user=self.user, date=datetime.datetime(2018, 1, 1, 10))
+            )
+            only_other.add_rsvp(models.RSVP(user=other))
+            version = both.reload().version
+
+            deleted = models.RSVP.move_to_user(other, self.user)
+            assert [r.user.id for r in deleted] == [self.user.email]
+            assert [r.id for r in both.reload().rsvps] == [kept.id]
+            assert both.rsvps[0].user.id == self.user.email
+            assert both.version > version
+            assert only_other.reload().rsvps[0].user.id == self.user.email
+            assert models.RSVP.objects(user=other).count() == 0
+
+    def test_attendance(self):
+        with app.test_request_context():
+            other = models.User(email="bar@example.com", name="Other").save()
+            first = models.Event(name="First", date=datetime.datetime(2018, 1, 1))
+            second = models.Event(name="Second", date=datetime.datetime(2018, 1, 2))
+            first.save()
+            second.save()
+            first.add_rsvp(models.RSVP(user=self.user))
+            first.add_rsvp(models.RSVP(user=other, waitlisted=True))
+            second.add_rsvp(models.RSVP(user=other))
+            second.add_rsvp(models.RSVP(user=self.user, cancelled=True))
+            rows = get_attendance([first, second]).splitlines()
+            assert rows[-2:] == ["Other,0,1", "Test User,1,0"]
+
+        with patch("rsvp.api.current_user", new=self.user):
+            response = self.client.get("/api/attendance")
+        attended = {(a["weekday"], a["attended"]) for a in response.json}
+        assert attended == {("1-Monday", 1), ("2-Tuesday", 0)}
+
+    def test_post_fragments_invalidated_on_save(self):
+        with app.test_request_context():
+            post = models.Post(
+                title="test-post", content="First *draft*", authors=[self.user]
+            )
+            post.save()
+            assert "<em>draft</em>" in fragment_cache.render("post-body", post)
+            byline = fragment_cache.render("post-byline", post)
+            assert "posted by Test User" in byline
+
+            post.content = "Final version"
+            post.save()
+            self.user.nick = "Tester"
+            self.user.save()
+            assert "Final version" in fragment_cache.render("post-body", post)
+            byline = fragment_cache.render("post-byline", post)
+            assert "posted by Tester" in byline
+
+    def test_renames_seen_by_all_processes(self):
+        with app.test_request_context():
+            post = models.Post(title="test-post", authors=[self.user])
+            post.save()
+            byline = fragment_cache.render("post-byline", post)
+            assert "posted by Test User" in byline
+        # Renamed in another process, which has a cache of its own
+        with patch.object(fragment_cache, "cache", SimpleCache()):
+            with app.test_request_context():
+                self.user.nick = "Tester"
+                self.user.save()
+        with app.test_request_context():
+            byline = fragment_cache.render("post-byline", post)
+            assert "posted by Tester" in byline
+
+    def test_post_page_cached_by_version(self):
+        with app.test_request_context():
+            post = models.Post(title="Cached", authors=[self.user], public=True)
+            post.save()
+        path = "/post/{}".format(post.id)
+
+        def render(template, post, description):
+            return "{} v{}".format(post.title, post.version)
+
+        with patch("rsvp.views.render_template", side_effect=render) as rendered:
+            response = self.client.get(path)
+            assert response.data == b"Cached v1"
+            etag = response.headers["ETag"]
+            assert "public" in response.headers["Cache-Control"]
+            assert "Cookie" in response.headers["Vary"]
+            assert self.client.get(path).data == b"Cached v1"
+            response = self.client.get(path, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert rendered.call_count == 1
+
+            # Edits made elsewhere, like in another worker, are seen
+            models.Post.objects(id=post.id).update(set__title="Edited", inc__version=1)
+            response = self.client.get(path, headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.data == b"Edited v2"
+            assert response.headers["ETag"] != etag
+
+            # Posts made private aren't served from the cache
+            with app.test_request_context():
+                post.reload()
+                post.public = False
+                post.save()
+            response = self.client.get(path)
+            assert response.status_code in (302, 401)
+            assert rendered.call_count == 2
+
 
 class TestApi(BaseTest):
     def jsonget(self, path):
@@ -48,16 +348,12 @@ class TestApi(BaseTest):
         assert self.jsonget("/api/rsvps/{}".format(event_id))["rsvps"] == []
         doc = self.jsonpost(
             "/api/rsvps/{}".format(event_id),
-            '{{"user": "{}", "rsvp_by": "test@example.com"}}'.format(
-                self.user.email
-            ),
+            '{{"user": "{}", "rsvp_by": "test@example.com"}}'.format(self.user.email),
         )
         assert doc["user"] == self.user.email
         assert doc["rsvp_by"] == "test@example.com"
         assert doc["_id"] is not None
-        assert (
-            len(self.jsonget("/api/rsvps/{}".format(event_id))["rsvps"]) == 1
-        )
+        assert len(self.jsonget("/api/rsvps/{}".format(event_id))["rsvps"]) == 1
 
     def test_rsvps_delete(self):
         data = {"name": "test-event", "date": "2018-01-01"}
@@ -70,9 +366,7 @@ class TestApi(BaseTest):
             "/api/rsvps/{}".format(event_id),
             '{{"user": "{}"}}'.format(self.user.email),
         )
-        assert (
-            len(self.jsonget("/api/rsvps/{}".format(event_id))["rsvps"]) == 1
-        )
+        assert len(self.jsonget("/api/rsvps/{}".format(event_id))["rsvps"]) == 1
         path = "/api/rsvps/{}/".format(event_id) + doc["_id"]["$oid"]
         self.client.delete(path)
         rsvps = self.jsonget("/api/rsvps/{}".format(event_id))["rsvps"]
@@ -80,3 +374,579 @@ class TestApi(BaseTest):
         assert rsvps[0]["cancelled"]
         response = self.client.get(path)
         assert response.status_code == 200
+
+    def test_concurrent_rsvps(self):
+        limit = 50
+        with app.test_request_context():
+            event = models.Event(name="Race", date="2018-01-01", rsvp_limit=limit)
+            event.save()
+            users = [
+                models.User(email="{}@example.com".format(i), name=str(i)).save()
+                for i in range(200)
+            ]
+        path = "/api/rsvps/{}".format(event.id)
+
+        def rsvp(args):
+            user, cancelled = args
+            data = {"user": user.email, "cancelled": cancelled}
+            response = self.client.post(path, data=json.dumps(data))
+            assert response.status_code == 200
+
+        # Widen the window between reading the RSVPs and updating the waitlist
+        waitlist_changes = models.Event.waitlist_changes
+
+        def slow_waitlist_changes(event):
+            time.sleep(0.001)
+            return waitlist_changes(event)
+
+        def run(requests):
+            with patch.object(
+                models.Event, "waitlist_changes", slow_waitlist_changes
+            ), ThreadPoolExecutor(max_workers=20) as executor:
+                list(executor.map(rsvp, requests))
+
+        run([(user, False) for user in users[:100]])
+        # Spots freed up by cancellations go to the earliest waitlisted RSVPs,
+        # while others keep RSVPing
+        cancelled = [r.user.fetch() for r in event.reload().active_rsvps[:30]]
+        run([(user, True) for user in cancelled] + [(u, False) for u in users[100:]])
+
+        event.reload()
+        assert len(event.rsvps) == len(users)
+        assert {r.user.id for r in event.rsvps} == {u.email for u in users}
+        rsvps = sorted(event.non_cancelled_rsvps, key=lambda r: (r.date, str(r.id)))
+        assert len(rsvps) == len(users) - len(cancelled)
+        assert event.active_rsvps == rsvps[:limit]
+        assert all(r.waitlisted for r in rsvps[limit:])
+
+    def test_waitlist_update_conflict(self):
+        with app.test_request_context():
+            event = models.Event(name="Race", date="2018-01-01", rsvp_limit=2)
+            event.save()
+            users = [
+                models.User(email="{}@example.com".format(i), name=str(i)).save()
+                for i in range(3)
+            ]
+        path = "/api/rsvps/{}".format(event.id)
+        for user in users:
+            self.jsonpost(path, json.dumps({"user": user.email}))
+        waitlist_changes = models.Event.waitlist_changes
+        calls = []
+
+        def lower_limit_while_updating(event_):
+            # The limit is lowered after the RSVPs were read, the first time
+            calls.append(event_.version)
+            if len(calls) == 1:
+                event.update(rsvp_limit=1, inc__version=1)
+            return waitlist_changes(event_)
+
+        with patch.object(models.Event, "waitlist_changes", lower_limit_while_updating):
+            self.jsonpost(path, json.dumps({"user": users[0].email, "cancelled": True}))
+        assert [r.user.id for r in event.reload().active_rsvps] == [users[1].email]
+        # The stale update was retried
+        assert len(calls) == 2
+
+    def test_waitlist_update_gives_up_under_contention(self):
+        with app.test_request_context():
+            event = models.Event(name="Race", date="2018-01-01", rsvp_limit=1)
+            event.save()
+            for i in range(2):
+                user = models.User(email="{}@example.com".format(i), name=str(i))
+                date = datetime.datetime(2018, 1, 1, 10, i)
+                event.add_rsvp(models.RSVP(user=user.save(), date=date))
+            event.update_waitlist()
+            first = event.active_rsvps[0]
+            event.update_rsvp(first, cancelled=True)
+        waitlist_changes = models.Event.waitlist_changes
+        calls = []
+
+        def keep_changing(event_):
+            # Other requests keep changing the RSVPs
+            calls.append(event_.version)
+            event.update(inc__version=1)
+            return waitlist_changes(event_)
+
+        promoted = []
+
+        def receiver(event, rsvps):
+            promoted.extend(rsvps)
+
+        with patch.object(models.Event, "waitlist_changes", keep_changing), patch(
+            "rsvp.models.time.sleep"
+        ), models.waitlist_promoted.connected_to(receiver):
+            assert not event.update_waitlist()
+        assert len(calls) == models.WAITLIST_ATTEMPTS
+        assert promoted == []
+        assert event.reload().waitlist_outdated
+        assert event.active_rsvps == []
+
+        # Left for the cron job
+        with models.waitlist_promoted.connected_to(receiver):
+            for event in models.Event.objects(waitlist_outdated=True):
+                assert event.update_waitlist()
+        assert [r.user.id for r in promoted] == ["1@example.com"]
+        assert not event.reload().waitlist_outdated
+        assert [r.user.id for r in event.active_rsvps] == ["1@example.com"]
+
+    def test_posts_paginated(self):
+        with app.test_request_context():
+            for i in range(5):
+                models.Post(
+                    title="post-{}".format(i),
+                    content="Some *content* for post {}".format(i),
+                    created_at=datetime.datetime(2018, 1, 1 + i),
+                    public=True,
+                ).save()
+        response = self.client.get("/api/posts/?limit=2")
+        posts = json.loads(response.data)
+        assert [post["title"] for post in posts] == ["post-4", "post-3"]
+        assert "content" not in posts[0]
+        assert posts[0]["excerpt"] == "Some content for post 4"
+
+        next_url = response.headers["Link"].split(";")[0].strip("<>")
+        posts = self.jsonget(next_url + "&full=1")
+        assert [post["title"] for post in posts] == ["post-2", "post-1"]
+        assert posts[0]["content"] == "Some *content* for post 2"
+
+        assert self.client.get("/api/posts/?before=bogus").status_code == 400
+
+
+class TestGDrive(BaseTest):
+    def test_refresh_gdrive_dirs(self):
+        drive = FakeDrive()
+        drive.add_folder("2019", "2019 Nationals", "root")
+        drive.add_folder("2018", "2018 Hat", "root")
+        drive.add_folder("2018-day-1", "Day 1", "2018")
+        with patch("rsvp.views.create_oauth_service", return_value=drive):
+            views.refresh_gdrive_dirs("root")
+            folders = models.GDriveFolder.objects(gdrive_parent="root")
+            assert sorted(folders.values_list("name")) == ["2018 Hat", "2019 Nationals"]
+
+            del drive.files_["2019"]
+            drive.add_folder("2020", "2020 Beach", "root")
+            views.refresh_gdrive_dirs("root")
+            folders = models.GDriveFolder.objects(gdrive_parent="root")
+            assert sorted(folders.values_list("name")) == ["2018 Hat", "2020 Beach"]
+
+    def test_empty_drive_sync_recorded(self):
+        drive = FakeDrive()
+        assert models.GDriveFolder.last_synced("root") is None
+        with patch("rsvp.views.create_oauth_service", return_value=drive):
+            views.refresh_gdrive_dirs("root")
+        # The view doesn't list the drive again, until the mirror is stale
+        assert models.GDriveFolder.objects.count() == 0
+        assert models.GDriveFolder.last_synced("root") is not None
+
+    def test_services_are_cached(self):
+        env = {
+            "GDRIVE_REFRESH_TOKEN": "refresh-token",
+            "GDRIVE_CLIENT_ID": "client-id",
+            "GDRIVE_CLIENT_SECRET": "client-secret",
+        }
+        with patch.dict(os.environ, env):
+            drive = create_oauth_service("drive")
+            assert create_oauth_service("drive") is drive
+            assert create_oauth_service("calendar") is not drive
+
+    def test_photos_follows_pagination(self):
+        drive = FakeDrive(page_size=2)
+        for year in range(2015, 2020):
+            year_id = str(year)
+            drive.add_folder(year_id, year_id, "root")
+            for day in range(1, 4):
+                day_id = "{}-{}".format(year, day)
+                drive.add_folder(day_id, "Day {}".format(day), year_id)
+                for i in range(3):
+                    drive.add_photo("{}-{}".format(day_id, i), day_id)
+
+        photos = list(gdrive_utils.photos(drive, "root", workers=4))
+        assert len(photos) == 5 * 3 * 3
+        assert {photo["gdrive_id"] for photo in photos} == {
+            id_ for id_, f in drive.files_.items() if f["mimeType"] == "image/jpeg"
+        }
+        photo = next(p for p in photos if p["gdrive_id"] == "2017-2-0")
+        assert photo["gdrive_path"] == "2017 > Day 2"
+        assert photo["gdrive_parent"] == "2017-2"
+
+    def test_photos_synced_incrementally(self):
+        drive = FakeDrive(page_size=2)
+        drive.add_folder("2019", "2019", "root")
+        drive.add_folder("2019-1", "Day 1", "2019")
+        drive.add_photo("a", "2019")
+        drive.add_photo("b", "2019-1")
+        drive.add_photo("c", "2019-1")
+        photo_sync.sync_photos(drive, "root")
+        photos = models.GDrivePhoto.objects
+        assert sorted(photos.values_list("gdrive_id")) == ["a", "b", "c"]
+        assert models.GDriveFolder.objects.count() == 2
+
+        drive.requests.clear()
+        drive.add_photo("d", "2019-1")
+        drive.update("a", parents=["2019-1"])
+        drive.update("b", trashed=True)
+        drive.remove("c")
+        drive.add_photo("elsewhere", "some-other-folder")
+        photo_sync.sync_photos(drive, "root")
+        assert all(request[0] == "changes.list" for request in drive.requests)
+        assert sorted(photos.values_list("gdrive_id")) == ["a", "d"]
+        assert photos.get(gdrive_id="a").gdrive_path == "2019 > Day 1"
+
+        # Folder changes need a full rescan
+        drive.requests.clear()
+        drive.add_folder("2019-2", "Day 2", "2019")
+        drive.add_photo("e", "2019-2")
+        photo_sync.sync_photos(drive, "root")
+        assert any(request[0] == "files.list" for request in drive.requests)
+        assert sorted(photos.values_list("gdrive_id")) == ["a", "d", "e"]
+        assert photos.get(gdrive_id="e").gdrive_path == "2019 > Day 2"
+        assert models.GDriveFolder.objects.count() == 3
+
+        drive.requests.clear()
+        photo_sync.sync_photos(drive, "root")
+        assert drive.requests == [("changes.list", str(len(drive.changes_)))]
+
+    def test_update_permissions_batched(self):
+        drive = FakeDrive()
+        drive.add_permission("owner@example.com", role="owner")
+        drive.add_permission("old@example.com")
+        drive.add_permission("kept@example.com")
+        emails = ["kept@example.com"] + [
+            "new-{}@example.com".format(i) for i in range(120)
+        ]
+        drive.rate_limited = 3
+        with patch("rsvp.gdrive_utils.time.sleep") as sleep:
+            summary = gdrive_utils.update_permissions(drive, "root", emails)
+        assert sleep.call_count == 1
+        assert drive.batches == [50, 50, 21, 3]
+        assert summary["removed"] == ["old@example.com"]
+        assert len(summary["added"]) == 120
+        assert summary["failed"] == []
+        assert sorted(p["emailAddress"] for p in drive.permissions_.values()) == sorted(
+            emails + ["owner@example.com"]
+        )
+
+
+class TestCalendarSync(BaseTest):
+    def setup_method(self, method):
+        super().setup_method(method)
+        self.today = datetime.date(2026, 1, 1)
+        self.environ = patch.dict(os.environ, {"RSVP_HOST": "https://example.com"})
+        self.environ.start()
+
+    def teardown_method(self, method):
+        self.environ.stop()
+
+    def create_events(self, n):
+        events = []
+        for i in range(n):
+            date = datetime.datetime(2026, 1, 2 + i, 6)
+            event = models.Event(name="Event {}".format(i), date=date)
+            events.append(event.save())
+        return events
+
+    def sync(self, calendar, full=False):
+        events = models.Event.objects.order_by("date")
+        return calendar_sync.sync_rsvp_events(
+            calendar, "calendar", events, "Asia/Kolkata", self.today, full=full
+        )
+
+    def test_sync_rsvp_events_batched(self):
+        calendar = FakeCalendar()
+        first, second, third = self.create_events(3)
+        assert self.sync(calendar) == {}
+        assert calendar.batches == [3]
+        assert sorted(e["summary"] for e in calendar.events_.values()) == [
+            "Event 0",
+            "Event 1",
+            "Event 2",
+        ]
+
+        calendar.requests.clear()
+        first.name = "Renamed"
+        first.save()
+        second.delete()
+        self.sync(calendar)
+        # Unchanged events are skipped, without listing the calendar
+        assert sorted(r[0] for r in calendar.requests) == [
+            "events.delete",
+            "events.update",
+        ]
+        assert sorted(e["summary"] for e in calendar.events_.values()) == [
+            "Event 2",
+            "Renamed",
+        ]
+
+        # A full reconcile re-creates events deleted from the calendar
+        calendar.requests.clear()
+        del calendar.events_[models.CalendarEventState.objects.first().event_id]
+        self.sync(calendar)
+        assert calendar.requests == []
+        self.sync(calendar, full=True)
+        assert [r[0] for r in calendar.requests] == ["events.list", "events.insert"]
+        assert len(calendar.events_) == 2
+
+    def test_list_events_paginated(self):
+        calendar = FakeCalendar(page_size=2)
+        self.create_events(5)
+        self.sync(calendar)
+        calendar.requests.clear()
+        events = gdrive_utils.list_events(calendar, "calendar")
+        assert calendar.requests == []  # Nothing is fetched until needed
+        assert len(list(events)) == 5
+        assert calendar.requests == [
+            ("events.list", None),
+            ("events.list", "2"),
+            ("events.list", "4"),
+        ]
+
+        sync_token = list(gdrive_utils.event_pages(calendar, "calendar"))[-1][
+            "nextSyncToken"
+        ]
+        deleted = next(iter(calendar.events_))
+        calendar.events().delete(calendarId="calendar", eventId=deleted).execute()
+        changed = list(
+            gdrive_utils.list_events(calendar, "calendar", syncToken=sync_token)
+        )
+        assert changed == [{"id": deleted, "status": "cancelled"}]
+
+    def drain(self, calendar):
+        return calendar_sync.drain_outbox(
+            calendar, "calendar", "Asia/Kolkata", self.today
+        )
+
+    def test_outbox_drained_to_calendar(self):
+        calendar = FakeCalendar()
+        first, second = self.create_events(2)
+        assert models.CalendarChange.objects.count() == 2
+        assert self.drain(calendar) == 2
+        assert models.CalendarChange.objects.count() == 0
+        assert len(calendar.events_) == 2
+
+        # Changes to RSVPs don't affect the calendar
+        first.add_rsvp(models.RSVP(user=self.user))
+        first.save()
+        assert models.CalendarChange.objects.count() == 0
+
+        first.name = "Renamed"
+        first.save()
+        first.description = "Changed"
+        first.save()
+        second.delete()
+        calendar.requests.clear()
+        calendar.rate_limited = 1
+        with patch("rsvp.gdrive_utils.time.sleep"):
+            assert self.drain(calendar) == 3
+        assert sorted(r[0] for r in calendar.requests) == [
+            "events.delete",
+            "events.update",
+        ]
+        assert [e["summary"] for e in calendar.events_.values()] == ["Renamed"]
+
+        # Failures are retried later
+        first.name = "Renamed again"
+        first.save()
+        calendar.rate_limited = 100
+        with patch("rsvp.gdrive_utils.time.sleep"):
+            assert self.drain(calendar) == 1
+        change = models.CalendarChange.objects.get()
+        assert change.attempts == 1
+        assert change.next_attempt_at > datetime.datetime.now()
+        assert self.drain(calendar) == 0
+
+    def test_outbox_drain_without_records_updates_calendar(self):
+        calendar = FakeCalendar()
+        first, second = self.create_events(2)
+        assert self.sync(calendar) == {}
+        # No records, like just after a deploy
+        models.CalendarChange.objects.delete()
+        models.CalendarEventState.objects.delete()
+        calendar.requests.clear()
+
+        first.name = "Renamed"
+        first.save()
+        assert self.drain(calendar) == 1
+        assert [r[0] for r in calendar.requests] == ["events.list", "events.update"]
+        assert sorted(e["summary"] for e in calendar.events_.values()) == [
+            "Event 1",
+            "Renamed",
+        ]
+        assert models.CalendarEventState.objects.count() == 1
+
+
+class TestMailer(BaseTest):
+    def test_queued_emails_sent_over_one_connection(self):
+        controller = pytest.importorskip("aiosmtpd.controller")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        recorder = SMTPRecorder()
+        server = controller.Controller(recorder, hostname="127.0.0.1", port=port)
+        other = models.User(email="bar@example.com", name="Other User").save()
+        with app.test_request_context():
+            assert send_email([self.user, other], "Hello", "Hi there!")
+        assert models.OutboxEmail.objects.count() == 2
+
+        connection = SMTPConnection(
+            "127.0.0.1", port, "noreply@example.com", starttls=False
+        )
+        server.start()
+        try:
+            assert send_pending(connection) == 2
+        finally:
+            server.stop()
+        assert models.OutboxEmail.objects.count() == 0
+        assert len(recorder.peers) == 1
+        assert sorted(to for (to,), _ in recorder.messages) == [
+            "bar@example.com",
+            "foo@example.com",
+        ]
+
+        # Emails are retried later, if the server is down
+        with app.test_request_context():
+            send_email([self.user], "Hello again", "Hi!")
+        assert send_pending(connection) == 0
+        email = models.OutboxEmail.objects.get()
+        assert email.attempts == 1
+        assert email.next_attempt_at > datetime.datetime.now()
+        connection.close()
+
+    def test_dropped_connection_closed_before_reconnecting(self):
+        connection = SMTPConnection("127.0.0.1", 25, "noreply@example.com")
+        dropped, fresh = MagicMock(), MagicMock()
+        dropped.sendmail.side_effect = smtplib.SMTPServerDisconnected
+        connection.server = dropped
+        with patch("rsvp.mailer.smtplib.SMTP", return_value=fresh):
+            connection.send("foo@example.com", "Hello", "Hi!")
+        dropped.close.assert_called_once_with()
+        fresh.sendmail.assert_called_once()
+        assert connection.server is fresh
+
+    def test_worker_sends_emails_pending_at_startup(self):
+        controller = pytest.importorskip("aiosmtpd.controller")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        recorder = SMTPRecorder()
+        server = controller.Controller(recorder, hostname="127.0.0.1", port=port)
+        # Queued by an earlier process, that never woke up a worker
+        models.OutboxEmail(to=self.user.email, subject="Hello", body="Hi!").save()
+
+        config = {
+            "EMAIL_WORKER": True,
+            "SMTP_HOST": "127.0.0.1",
+            "SMTP_PORT": port,
+            "SMTP_STARTTLS": False,
+            "SMTP_USER": None,
+            "SMTP_MAX_CONNECTIONS": 1,
+        }
+        server.start()
+        try:
+            with patch.dict(app.config, config):
+                worker = MailWorker(app)
+                worker.start()
+                try:
+                    for _ in range(50):
+                        if not models.OutboxEmail.objects.count():
+                            break
+                        time.sleep(0.1)
+                finally:
+                    worker.stop()
+        finally:
+            server.stop()
+        assert models.OutboxEmail.objects.count() == 0
+        assert [to for (to,), _ in recorder.messages] == [self.user.email]
+
+    def test_notify_santas_queues_all_emails(self):
+        from rsvp.rudolph import notify_santas
+
+        emails = ["santa-{}@example.com".format(i) for i in range(6)]
+        for i, email in enumerate(emails):
+            models.User(email=email, name="Santa {}".format(i)).save()
+        pairs = list(zip(emails, emails[1:] + emails[:1]))
+        with app.test_request_context():
+            notify_santas(pairs, test=False)
+        queued = {email.to: email.body for email in models.OutboxEmail.objects}
+        assert sorted(queued) == sorted(emails)
+        assert "kiddo is *Santa 1*" in queued["santa-0@example.com"]
+
+
+class TestRudolph:
+    def test_pick_pairs_with_exclusions(self):
+        from types import SimpleNamespace
+
+        from rsvp.rudolph import couples_exclusions, is_good_pairing, pick_pairs
+
+        people = [SimpleNamespace(email="{}@example.com".format(i)) for i in range(60)]
+        emails = [person.email for person in people]
+        rng = random.Random(42)
+        last_year = pick_pairs(people, rng=rng)
+        assert is_good_pairing(last_year, people)
+        exclusions = couples_exclusions(zip(emails[::2], emails[1::2]))
+        exclusions |= set(last_year)
+        for santa in emails:
+            exclusions.update((santa, kiddo) for kiddo in rng.sample(emails, 40))
+
+        pairs = pick_pairs(people, exclusions, random.Random("seed"))
+        assert is_good_pairing(pairs, people, exclusions)
+        # The same seed gives the same pairs
+        assert pick_pairs(people, exclusions, random.Random("seed")) == pairs
+
+        with pytest.raises(ValueError):
+            pick_pairs(people[:2], couples_exclusions([emails[:2]]))
+
+
+class TestNotifications(BaseTest):
+    def test_waitlist_promotions_emailed_in_one_batch(self):
+        from rsvp.notifications import notification_dispatcher
+
+        users = [self.user] + [
+            models.User(email="{}@example.com".format(i), name=str(i)).save()
+            for i in range(3)
+        ]
+        event = models.Event(name="Hat", date=datetime.datetime.now(), rsvp_limit=1)
+        event.save()
+        for i, user in enumerate(users):
+            date = datetime.datetime(2026, 1, 1, 10, i)
+            event.add_rsvp(models.RSVP(user=user, date=date))
+        event.update_waitlist()
+        assert [r.user.id for r in event.active_rsvps] == [self.user.email]
+
+        event.update_rsvp(event.active_rsvps[0], cancelled=True)
+        event.update_waitlist()
+        event.update(rsvp_limit=3)
+        event.update_waitlist()
+        event.update(rsvp_limit=2)
+        event.update_waitlist()
+        with app.test_request_context():
+            with patch.dict(os.environ, {"RSVP_HOST": "https://example.com"}):
+                notification_dispatcher.flush()
+        # Each user still holding a spot is notified once
+        emails = models.OutboxEmail.objects
+        assert sorted(emails.values_list("to")) == ["0@example.com", "1@example.com"]
+        assert "https://example.com/event/{}".format(event.id) in emails[0].body
+
+    def test_promotions_without_dispatcher_are_notified_later(self):
+        from rsvp.notifications import NotificationDispatcher
+
+        other = models.User(email="0@example.com", name="0").save()
+        event = models.Event(name="Hat", date=datetime.datetime.now(), rsvp_limit=1)
+        event.save()
+        for i, user in enumerate((self.user, other)):
+            date = datetime.datetime(2026, 1, 1, 10, i)
+            event.add_rsvp(models.RSVP(user=user, date=date))
+        event.update_waitlist()
+        # Promoted by a script, say, where no dispatcher is running
+        with patch.object(models.waitlist_promoted, "send"):
+            event.update_rsvp(event.active_rsvps[0], cancelled=True)
+            event.update_waitlist()
+        assert models.WaitlistPromotion.objects.count() == 1
+
+        # Sent by the cron job, or by a web server process
+        dispatcher = NotificationDispatcher(app)
+        with app.test_request_context():
+            with patch.dict(os.environ, {"RSVP_HOST": "https://example.com"}):
+                assert dispatcher.flush() == 1
+        assert list(models.OutboxEmail.objects.values_list("to")) == [other.email]
+        assert models.WaitlistPromotion.objects.count() == 0
+        with app.test_request_context():
+            assert dispatcher.flush() == 0
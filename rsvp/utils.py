@@ -4,13 +4,11 @@ import csv
 import io
 import os
 import re
-import smtplib
 import string
 from datetime import datetime
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from functools import wraps
+from functools import lru_cache, wraps
 from hashlib import pbkdf2_hmac
+from html import unescape
 from random import choice, shuffle
 
 import mistune
@@ -39,6 +37,7 @@ def get_aspect_ratio(width, height, rotation):
 
 
 SLUG_RE = re.compile("[^A-Za-z]+")
+TAG_RE = re.compile("<[^>]+>")
 
 
 class BootstrapMarkdownRenderer(mistune.HTMLRenderer):
@@ -66,16 +65,25 @@ def get_slug(text):
 
 
 def get_attendance(events):
-    users = {rsvp.user for e in events for rsvp in e.rsvps}
+    from .models import RSVP, User
+
+    events = list(events)
     dates = ["{:%Y-%m-%d}\n{}".format(e.date, e.name) for e in events]
     header = ["Names"] + dates
-    attendance = {
-        user: [e.active_rsvps.filter(user=user).count() for e in events]
-        for user in users
-    }
+    # The RSVPs of all the events are fetched together
+    attended = {e.id: set() for e in events}
+    rsvps = RSVP.objects(event__in=list(attended)).only(
+        "event", "user", "cancelled", "waitlisted"
+    )
+    emails = set()
+    for rsvp in rsvps.as_pymongo():
+        emails.add(rsvp["user"])
+        if not rsvp.get("cancelled") and not rsvp.get("waitlisted"):
+            attended[rsvp["event"]].add(rsvp["user"])
+    users = User.objects.in_bulk(list(emails))
     rows = [
-        [user.fetch().nick_name] + marked_attendance
-        for user, marked_attendance in attendance.items()
+        [users[email].nick_name] + [int(email in attended[e.id]) for e in events]
+        for email in emails
     ]
     rows = sorted(rows, key=lambda x: x[0].lower())
     output = io.StringIO()
@@ -112,6 +120,20 @@ def markdown_to_html(md):
     return mistune.markdown(md, escape=False, renderer=renderer)
 
 
+def html_excerpt(html, n=200):
+    """Plain text summary of (roughly) the first n characters of html."""
+    text = " ".join(unescape(TAG_RE.sub(" ", html or "")).split())
+    if len(text) <= n:
+        return text
+    return text[:n].rsplit(" ", 1)[0] + "…"
+
+
+def mongo_now():
+    """The current time, truncated to the millisecond precision of Mongo."""
+    now = datetime.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
 def random_id():
     return ObjectId(bytes(random_string(), "ascii"))
 
@@ -123,7 +145,9 @@ def random_string(n=12):
 def read_app_config():
     settings = os.environ["SETTINGS"]
     settings_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), settings)
-    config = {}
+    # Like Flask's from_pyfile, so that settings can import the ones next to
+    # them, as settings/test.py does
+    config = {"__file__": settings_path}
     with open(settings_path) as f:
         exec(f.read(), config)
     return config
@@ -162,6 +186,9 @@ def role_required(role="ALL"):
     return wrapper
 
 
+# The derivation is deliberately slow, and always gives the same password for
+# the same inputs, so it is done only once per process.
+@lru_cache(maxsize=None)
 def generate_password(tag, salt, n=32):
     hash_name = "sha256"
     iterations = 150000
@@ -171,6 +198,13 @@ def generate_password(tag, salt, n=32):
     return base64.b85encode(bytes(tag_hash, "ascii"))[:n].decode("ascii")
 
 
+def precompute_passwords(platforms, salt):
+    """Fill the password cache for social accounts, e.g., in a thread at startup."""
+    for platform in platforms:
+        if platform["type"] == "account":
+            generate_password(platform["name"], salt)
+
+
 def send_approval_email(user, admins):
     to_users = admins
     subject = "{} is awaiting your approval".format(user.name)
@@ -186,39 +220,11 @@ def send_approved_email(user):
 
 
 def send_email(to_users, subject, body):
-    # Gmail SMTP server configuration
-    smtp_server = "smtp.zeptomail.in"
-    smtp_port = 587  # Port for TLS
-    smtp_user = os.environ.get("ZEPTOMAIL_USER")
-    smtp_password = os.environ.get("ZEPTOMAIL_PASSWORD")
+    """Queue an email to each of the users, to be sent in the background."""
+    from .mailer import queue_email
 
-    # Sender's email
-    from_email = os.environ.get("FROM_EMAIL", "noreply@tiks-ultimate.in")
-
-    try:
-        # Establish a secure session with Gmail's SMTP server
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()  # Upgrade the connection to secure
-        server.login(smtp_user, smtp_password)
-
-        # Send the email to each recipient individually
-        for user in to_users:
-            # Create a new message for each recipient
-            msg = MIMEMultipart()
-            msg["Subject"] = subject
-            msg["From"] = from_email
-            msg["To"] = user.email
-            msg.attach(MIMEText(body, "plain"))
-
-            # Send the email
-            server.sendmail(from_email, [user.email], msg.as_string())
-
-        # Quit the SMTP session
-        server.quit()
-        return True
-    except Exception as e:
-        print(e)
-        return False
+    queue_email(to_users, subject, body)
+    return True
 
 
 def event_absolute_url(event):
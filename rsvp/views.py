@@ -1,11 +1,14 @@
 import copy
+import datetime
 import json
 import mimetypes
 import os
+import random
 import re
-from urllib.parse import urlparse, urlunparse
+import threading
 
 from flask import (
+    abort,
     current_app,
     flash,
     jsonify,
@@ -26,16 +29,26 @@ from flask_login import (
     logout_user,
 )
 from mongoengine.errors import DoesNotExist, ValidationError
+from werkzeug.security import safe_join
 
 from . import app
+from .cache import page_cache, profile_generation
 from .cloudinary_utils import image_url, list_images
 from .gdrive_utils import (
     create_folder,
     create_oauth_service,
-    list_sub_dirs,
+    folder_tree,
     upload_photo,
 )
-from .models import Event, GDrivePhoto, InterestedUser, Post, User
+from .models import (
+    Event,
+    EventSummary,
+    GDriveFolder,
+    GDrivePhoto,
+    InterestedUser,
+    Post,
+    User,
+)
 from .utils import (
     format_gphoto_time,
     generate_password,
@@ -46,25 +59,43 @@ from .utils import (
 )
 
 
-@app.before_request
-def redirect_heroku():
-    """Redirect old URL/herokuapp requests to rsvp.tiks-ultimate.in."""
-    urlparts = urlparse(request.url)
-    domain_name = "rsvp.tiks-ultimate.in"
-    old_domain_name = "thatte-idli-rsvp.herokuapp.com"
-    fly_domain_name = "tiks-ultimate-rsvp.fly.dev"
-    if urlparts.netloc in {old_domain_name, fly_domain_name}:
-        urlparts_list = list(urlparts)
-        urlparts_list[1] = domain_name
-        return redirect(urlunparse(urlparts_list), code=301)
+# Views ####
 
 
-# Views ####
+# Pre-compressed variants of static files, created by scripts/compress_static
+STATIC_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+ONE_YEAR = 365 * 24 * 60 * 60
 
 
 @app.route("/version-<version>/<path:static_file>")
 def versioned_static(version, static_file):
-    return send_file(static_file)
+    # The version changes whenever the file does, so the URL can be cached forever
+    prefix = app.static_url_path.strip("/") + "/"
+    static_file = static_file.lstrip("/")
+    if not static_file.startswith(prefix):
+        abort(404)
+    filename = static_file[len(prefix) :]
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding, extension in STATIC_ENCODINGS:
+        compressed = path + extension
+        if (
+            encoding in request.accept_encodings
+            and os.path.isfile(compressed)
+            and os.path.getmtime(compressed) >= os.path.getmtime(path)
+        ):
+            response = send_file(compressed, mimetype=mimetype, max_age=ONE_YEAR)
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_file(path, mimetype=mimetype, max_age=ONE_YEAR)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 # Event Views #########################################################
@@ -73,7 +104,7 @@ def versioned_static(version, static_file):
 @app.route("/")
 @login_required
 def index():
-    upcoming_events = Event.objects.filter(archived=False).order_by("date")
+    upcoming_events = EventSummary.upcoming()
     posts = Post.objects.filter(draft=False).order_by("-created_at")[:2]
     photos = list(GDrivePhoto.objects)
     photos = get_random_photos(photos) if photos else []
@@ -101,9 +132,9 @@ def event(id):
     approved_users = [
         dict(zip(fields, user)) for user in approved_users.values_list(*fields)
     ]
-    rsvps = event.all_rsvps
-    count = event.rsvp_count
-    female_count = len(event.female_rsvps)
+    rsvps = event.rsvp_partition
+    count = len(rsvps.active)
+    female_count = len(rsvps.with_gender("female"))
     male_count = count - female_count
     return render_template(
         "event.html",
@@ -111,8 +142,7 @@ def event(id):
         male_count=male_count,
         female_count=female_count,
         event=event,
-        items=rsvps,
-        active_rsvps=event.active_rsvps,
+        rsvps=rsvps,
         approved_users=approved_users,
         TEXT2=event.title,
         description=description,
@@ -375,23 +405,55 @@ def attendance():
 @app.route("/posts")
 @login_required
 def show_posts():
-    posts = Post.objects.order_by("-created_at")
+    try:
+        posts, next_cursor = Post.page(
+            Post.objects,
+            before=request.args.get("before"),
+            limit=app.config["POSTS_PER_PAGE"],
+        )
+    except ValueError:
+        abort(400)
     return render_template(
-        "posts.html", posts=posts, show_year=True, hide_all_link=True
+        "posts.html",
+        posts=posts,
+        next_cursor=next_cursor,
+        show_year=True,
+        hide_all_link=True,
     )
 
 
 @app.route("/post/<id>")
 def show_post(id):
-    post = Post.objects.get(id=id)
-    if not post.public and not current_user.is_authenticated:
+    anonymous = not current_user.is_authenticated
+    if anonymous:
+        # Pages of edited posts, even if edited in other processes, are missed
+        version = Post.objects(id=id).scalar("version").first()
+        version = "{}-{}".format(version, profile_generation())
+        cached = page_cache.get(page_cache.key("post", id, version))
+        if cached is not None:
+            return page_cache.make_response(*cached)
+
+    # Authors and the body are only needed if the fragments aren't cached
+    post = (
+        Post.objects.no_dereference().exclude("content", "html_content").get(id=id)
+    )
+    if not post.public and anonymous:
         return current_app.login_manager.unauthorized()
-    description = post.content[:100] if post.public else "Private post"
-    return render_template(
+    description = (post.excerpt or "")[:100] if post.public else "Private post"
+    # Pages with flashed messages are specific to the visitor
+    cacheable = anonymous and "_flashes" not in session
+    body = render_template(
         "post.html",
         post=post,
         description=description,
     )
+    if not cacheable:
+        return body
+
+    version = "{}-{}".format(post.version, profile_generation())
+    etag = "{}-{}".format(post.id, version)
+    page_cache.set(page_cache.key("post", post.id, version), etag, body)
+    return page_cache.make_response(etag, body)
 
 
 @app.route("/edit-post/<id>", methods=["GET"])
@@ -462,9 +524,24 @@ def media():
                 continue
 
             platform["password"] = generate_password(platform["name"], app.secret_key)
-    service = create_oauth_service()
     gdrive_root = os.environ["GOOGLE_DRIVE_MEDIA_DRIVE_ID"]
-    gdrive_dirs = sorted(list_sub_dirs(service, gdrive_root), key=lambda x: x["name"])
+    # Serve the folders mirrored from the drive, and refresh them in the
+    # background if they are stale. Drive is only called in the request the
+    # first time around, when there's nothing to serve.
+    last_synced = GDriveFolder.last_synced(gdrive_root)
+    if last_synced is None:
+        try:
+            refresh_gdrive_dirs(gdrive_root)
+        except Exception as e:
+            print("Failed to list GDrive directories: {}".format(e))
+            flash("Could not fetch the GDrive directories", "warning")
+    elif datetime.datetime.now() - last_synced > datetime.timedelta(
+        seconds=app.config["GDRIVE_FOLDERS_MAX_AGE"]
+    ):
+        threading.Thread(
+            target=refresh_gdrive_dirs, args=(gdrive_root,), daemon=True
+        ).start()
+    gdrive_dirs = GDriveFolder.objects(gdrive_parent=gdrive_root).order_by("name")
     youtube_playlist = os.environ.get("YOUTUBE_PLAYLIST_ID")
     photos = GDrivePhoto.new_photos(7)
     return render_template(
@@ -476,6 +553,23 @@ def media():
     )
 
 
+_gdrive_dirs_refresh = threading.Lock()
+
+
+def refresh_gdrive_dirs(gdrive_root):
+    """Update the mirror of the top level folders in the media drive."""
+    # Skip, if a refresh is already running
+    if not _gdrive_dirs_refresh.acquire(blocking=False):
+        return
+
+    try:
+        service = create_oauth_service()
+        folders = folder_tree(service, gdrive_root, top_level_only=True)
+        GDriveFolder.sync(folders, gdrive_root, top_level_only=True)
+    finally:
+        _gdrive_dirs_refresh.release()
+
+
 @app.route("/photo-map", methods=["GET"])
 @login_required
 def photo_map():
@@ -507,17 +601,29 @@ def photo_map():
 @login_required
 @role_required("secret-santa-admin")
 def secret_santa(event_id):
-    from rsvp.rudolph import get_people, main
+    from rsvp.rudolph import couples_exclusions, get_people, main
 
     people = get_people(event_id)
     if request.method == "GET":
         return render_template("secret-santa.html", people=people, event_id=event_id)
 
+    def read_pairs(name):
+        lines = request.form.get(name, "").splitlines()
+        pairs = [[e.strip() for e in line.split(",")] for line in lines if line.strip()]
+        if any(len(pair) != 2 for pair in pairs):
+            abort(400, "Enter one pair of comma separated emails per line")
+        return [tuple(pair) for pair in pairs]
+
+    exclusions = couples_exclusions(read_pairs("couples")) | set(read_pairs("avoid"))
+    seed = request.form.get("seed") or str(random.randrange(10**6))
     test_run = not request.form.get("live-run") == "on"
-    pairs = main(people=people, test=test_run)
+    try:
+        pairs = main(people=people, test=test_run, exclusions=exclusions, seed=seed)
+    except ValueError as e:
+        abort(400, str(e))
+    people_by_email = {person.email: person for person in people}
     pairs = [
-        (User.objects.get(email=santa), User.objects.get(email=kiddo))
-        for (santa, kiddo) in pairs
+        (people_by_email[santa], people_by_email[kiddo]) for (santa, kiddo) in pairs
     ]
     if test_run:
         return render_template(
@@ -526,6 +632,9 @@ def secret_santa(event_id):
             pairs=pairs,
             people=people,
             test_run=test_run,
+            seed=seed,
+            couples=request.form.get("couples", ""),
+            avoid=request.form.get("avoid", ""),
         )
     else:
         return "Santas notified"
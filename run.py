@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 from rsvp import app
+from rsvp.app import start_background_workers
 
 if __name__ == '__main__':
     app.jinja_env.cache = None
+    start_background_workers()
     app.run(host='0.0.0.0')
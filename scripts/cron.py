@@ -21,11 +21,34 @@ def daily():
     subprocess.check_call([str(script)], cwd=HERE.parent)
 
 
+def calendar_outbox():
+    script = HERE.joinpath("gdrive_sync")
+    # A failure is retried in a minute, and mustn't stop the scheduler
+    subprocess.call(["python", str(script), "drain-calendar-outbox"], cwd=HERE.parent)
+
+
+def notifications():
+    script = HERE.joinpath("manage_events")
+    # Updates the waitlists that requests gave up on, before notifying users
+    subprocess.call(["python", str(script), "update-waitlists"], cwd=HERE.parent)
+    # Sends the notifications of promotions made by scripts, or left behind
+    subprocess.call(["python", str(script), "send-notifications"], cwd=HERE.parent)
+
+
+def email_outbox():
+    script = HERE.joinpath("manage_users")
+    # Sends the emails queued by scripts, and retries, if the web app doesn't
+    subprocess.call(["python", str(script), "drain-email-outbox"], cwd=HERE.parent)
+
+
 def heartbeat():
     print(f"Heartbeat: {time.ctime()}", flush=True)
 
 
 schedule.every().minute.do(heartbeat)
+schedule.every().minute.do(calendar_outbox)
+schedule.every().minute.do(notifications)
+schedule.every().minute.do(email_outbox)
 schedule.every().hour.do(hourly)
 schedule.every().day.at("10:30").do(daily)
 